@@ -0,0 +1,88 @@
+"""
+Peak memory of the visibility stage on synthetic DEMs.
+
+Every case runs in a fresh interpreter that loads the DEM from disk, so the reported peak is the resident set of
+that process alone. The growth column is the peak minus the resident set right before the visibility call.
+
+    python -m benchmark.memory --dem ridge --radius 5000 --pixel-size 0.0000925926
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import numpy as np
+from benchmark.synthetic import DEMS, EARTH_RADIUS, get_geotransform, get_shape
+
+OBSERVER = (-105.0, 40.0)
+
+
+def get_peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024.0 if sys.platform != 'darwin' else peak / 1048576.0
+
+
+def run_case(path, radius, pixel_size, engine, algorithm):
+    from mvc.modeller.algorithm import calculate_visibility
+    matrix = np.load(path)
+    geotransform = get_geotransform(OBSERVER, matrix.shape, pixel_size)
+    before = get_peak_rss()
+    start = time.time()
+    array = calculate_visibility(OBSERVER, 1.7, 0.0, radius, 0.15, True, True, 0.13, True, EARTH_RADIUS, False,
+                                 engine, algorithm, 1, geotransform, matrix)
+    elapsed = time.time() - start
+    peak = get_peak_rss()
+    return {
+        'shape': list(matrix.shape),
+        'visible': int(np.count_nonzero(array)),
+        'seconds': round(elapsed, 3),
+        'peak_mb': round(peak, 1),
+        'growth_mb': round(peak - before, 1)
+    }
+
+
+def run(dems, radius, pixel_size, engine, algorithm):
+    shape = get_shape(OBSERVER, radius, pixel_size)
+    folder = tempfile.mkdtemp(prefix='viewshed-memory-')
+    results = dict()
+    try:
+        for name in dems:
+            path = os.path.join(folder, name + '.npy')
+            np.save(path, DEMS[name](shape))
+            out = subprocess.check_output([sys.executable, '-m', 'benchmark.memory', '--case', path,
+                                           '--radius', str(radius), '--pixel-size', repr(pixel_size),
+                                           '--engine', engine, '--algorithm', algorithm])
+            results[name] = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Peak RSS of the visibility stage on synthetic DEMs.')
+    parser.add_argument('--dem', action='append', choices=sorted(DEMS.keys()))
+    parser.add_argument('--radius', type=float, default=5000.0)
+    parser.add_argument('--pixel-size', type=float, default=1.0 / 10800)
+    parser.add_argument('--engine', default='numpy', choices=['numpy', 'loop', 'template'])
+    parser.add_argument('--algorithm', default='ray', choices=['ray', 'sweep'])
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.case:
+        print(json.dumps(run_case(args.case, args.radius, args.pixel_size, args.engine, args.algorithm)))
+        return
+    results = run(args.dem or sorted(DEMS.keys()), args.radius, args.pixel_size, args.engine, args.algorithm)
+    print('{:<8}{:>14}{:>10}{:>10}{:>12}{:>12}'.format('dem', 'shape', 'visible', 'seconds', 'peak MB',
+                                                          'growth MB'))
+    for name in sorted(results):
+        r = results[name]
+        print('{:<8}{:>14}{:>10}{:>10}{:>12}{:>12}'.format(name, '{}x{}'.format(*r['shape']), r['visible'],
+                                                              r['seconds'], r['peak_mb'], r['growth_mb']))
+
+
+if __name__ == '__main__':
+    main()
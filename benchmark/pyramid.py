@@ -0,0 +1,77 @@
+"""
+Full resolution against pyramid viewsheds for long view distances, on a synthetic DEM.
+
+For every radius the full resolution viewshed runs with the auto swath, then the pyramid one reads the same DEM. Each
+level of the pyramid is reported with its timings and how it agrees with the full resolution viewshed on its ring:
+recall is the share of cells visible at full resolution that fall in a visible pyramid cell, visible is the area found
+visible by the pyramid over the area found visible at full resolution.
+
+    python -m benchmark.pyramid --radius 10000,20000,50000 --dem ridge
+"""
+import time
+import argparse
+import numpy as np
+from benchmark.memory import OBSERVER
+from benchmark.synthetic import DEMS, EARTH_RADIUS, get_geotransform, get_shape, dem2geotiff
+
+PIXEL_SIZE = 1.0 / 3600
+
+
+def get_level_agreement(geotransform, array, level_geotransform, level_array, distance):
+    # Full resolution cells are compared with the pyramid cell holding their center, on the ring of the level only
+    rows, cols = np.mgrid[0:array.shape[0], 0:array.shape[1]]
+    lon = geotransform[0] + (cols + 0.5) * geotransform[1]
+    lat = geotransform[3] + (rows + 0.5) * geotransform[5]
+    u = np.floor((lon - level_geotransform[0]) / level_geotransform[1]).astype(np.intp)
+    v = np.floor((lat - level_geotransform[3]) / level_geotransform[5]).astype(np.intp)
+    inside = (u >= 0) & (v >= 0) & (u < level_array.shape[1]) & (v < level_array.shape[0])
+    d = np.hypot(np.radians(lon - OBSERVER[0]) * np.cos(np.radians(OBSERVER[1])),
+                 np.radians(lat - OBSERVER[1])) * EARTH_RADIUS
+    ring = inside & (d > distance[0]) & (d <= distance[1])
+    full = (array > 0) & ring
+    pyramid = np.zeros(array.shape, dtype=bool)
+    pyramid[inside] = level_array[v[inside], u[inside]] > 0
+    pyramid &= ring
+    recall = pyramid[full].mean() if full.any() else 1.0
+    ratio = pyramid.sum() / float(full.sum()) if full.any() else 0.0
+    return recall, ratio
+
+
+def run(dem, radius, height):
+    from osgeo import gdal
+    from mvc.modeller.algorithm import raster_visibility, pyramid_visibility
+    shape = get_shape(OBSERVER, radius, PIXEL_SIZE)
+    geotiff = dem2geotiff(DEMS[dem](shape), get_geotransform(OBSERVER, shape, PIXEL_SIZE))
+    try:
+        start = time.time()
+        geotransform, array = raster_visibility(OBSERVER, height, 0.0, radius, 'auto', True, True, 0.13, True,
+                                                EARTH_RADIUS, False, 'numpy', 'ray', 1, geotiff)
+        full = time.time() - start
+        start = time.time()
+        levels = pyramid_visibility(OBSERVER, height, 0.0, radius, True, True, 0.13, EARTH_RADIUS, False, geotiff)
+        pyramid = time.time() - start
+    finally:
+        gdal.Unlink(geotiff)
+    print('{:g} m: full resolution {:.2f}s, pyramid {:.2f}s'.format(radius, full, pyramid))
+    for level_geotransform, level_array, summary in levels:
+        recall, ratio = get_level_agreement(geotransform, array, level_geotransform, level_array,
+                                            summary['distance'])
+        print('  {:<6}{:>16}{:>10.1f}{:>10.2f}{:>10.3f}{:>12.3f}{:>10.3f}{:>10.2f}'.format(
+            summary['level'], '{:g}-{:g}'.format(*summary['distance']), summary['cell_size'], summary['relief_bias'],
+            summary['seconds']['read'], summary['seconds']['visibility'], recall, ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare full resolution and pyramid viewsheds.')
+    parser.add_argument('--radius', default='10000,20000', help='comma separated view distances (meter)')
+    parser.add_argument('--dem', default='ridge', choices=sorted(DEMS.keys()))
+    parser.add_argument('--height', type=float, default=30.0, help='observer height from ground (meter)')
+    args = parser.parse_args()
+    print('  {:<6}{:>16}{:>10}{:>10}{:>10}{:>12}{:>10}{:>10}'.format('level', 'ring m', 'cell m', 'bias m', 'read s',
+                                                                    'visibility s', 'recall', 'visible'))
+    for radius in [float(value) for value in args.radius.split(',')]:
+        run(args.dem, radius, args.height)
+
+
+if __name__ == '__main__':
+    main()
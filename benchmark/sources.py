@@ -0,0 +1,122 @@
+"""
+Per-request DEM latency of the WCS and the local DEM sources.
+
+Both sources serve the same synthetic DEM, written to a GeoTIFF on disk. Unless --url points to a real GeoServer,
+the WCS source talks to a minimal WCS server on localhost that cuts coverages out of that file, so the difference
+is the HTTP hop and the GeoTIFF encoding and decoding around it. A request is timed from opening the DEM of the
+observer bbox to reading its window, as ViewShed.analysis does.
+
+    python -m benchmark.sources --requests 200
+    python -m benchmark.sources --url http://localhost/geoserver/wcs --layer demo:srtm1v3elevation --dem /data/x.vrt
+"""
+import os
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+import threading
+import urlparse
+import BaseHTTPServer
+import numpy as np
+from osgeo import gdal
+from benchmark.synthetic import DEMS, get_geotransform
+from mvc.modeller.wcs import WcsClient
+from mvc.modeller.source import WcsDemSource, LocalDemSource
+from mvc.modeller.algorithm import array2raster, read_image, read_vsimem, viewshed_bbox
+
+LAYER = 'synthetic:dem'
+CENTER = (-105.0, 40.0)
+
+
+class CoverageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Answers WCS 2.0 GetCoverage requests with Long/Lat subsets, like GeoServer does for a GeoTIFF coverage
+    protocol_version = 'HTTP/1.1'
+    dem = None
+
+    def do_GET(self):
+        subsets = urlparse.parse_qs(urlparse.urlparse(self.path).query).get('subset', [])
+        bounds = dict((subset.split('(')[0], [float(v) for v in subset[:-1].split('(')[1].split(',')])
+                      for subset in subsets)
+        coverage = '/vsimem/' + str(uuid.uuid4()) + '.tif'
+        gdal.Translate(coverage, self.dem, format='GTiff',
+                       projWin=[bounds['Long'][0], bounds['Lat'][1], bounds['Long'][1], bounds['Lat'][0]])
+        body = read_vsimem(coverage)
+        gdal.Unlink(coverage)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/tiff')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def write_dem(path, size, pixel_size):
+    geotransform = get_geotransform(CENTER, (size, size), pixel_size)
+    array2raster(path, (geotransform[0], geotransform[3]), geotransform[1], geotransform[5],
+                 DEMS['ridge']((size, size)), gdal.GDT_Float32)
+
+
+def time_source(source, layer, observers, radius):
+    latencies = list()
+    for x, y in observers:
+        bbox = viewshed_bbox(x, y, radius)
+        start = time.time()
+        dem = source.open(layer, *bbox)
+        read_image(dem, bbox)
+        source.release(dem)
+        latencies.append(time.time() - start)
+    return np.array(latencies) * 1000.0
+
+
+def get_observers(count, spread, seed=0):
+    rs = np.random.RandomState(seed)
+    return [(CENTER[0] + dx, CENTER[1] + dy) for dx, dy in rs.uniform(-spread, spread, (count, 2))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-request latency of the WCS and local DEM sources.')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--radius', type=float, default=5000.0)
+    parser.add_argument('--url', help='GeoServer WCS endpoint, a local WCS server is started when omitted')
+    parser.add_argument('--layer', default=LAYER, help='coverage of --url, also used as the local layer name')
+    parser.add_argument('--dem', help='local GeoTIFF or VRT holding the same coverage as --url')
+    parser.add_argument('--spread', type=float, default=0.05, help='degrees around -105,40 observers fall in')
+    args = parser.parse_args()
+    folder = tempfile.mkdtemp(prefix='viewshed-sources-')
+    server = None
+    try:
+        path = args.dem
+        if path is None:
+            path = os.path.join(folder, 'dem.tif')
+            write_dem(path, 1440, 1.0 / 3600)
+        url = args.url
+        if url is None:
+            CoverageHandler.dem = gdal.Open(path)
+            server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), CoverageHandler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            url = 'http://127.0.0.1:%s/geoserver/wcs' % server.server_port
+        observers = get_observers(args.requests, args.spread)
+        sources = [
+            ('wcs', WcsDemSource(WcsClient(url, 4, (3.05, 60), 0, 0))),
+            ('local', LocalDemSource({args.layer: path}))
+        ]
+        print('{:<8}{:>10}{:>10}{:>10}{:>10}'.format('source', 'mean ms', 'p50 ms', 'p95 ms', 'max ms'))
+        for name, source in sources:
+            time_source(source, args.layer, observers[:1], args.radius)
+            latencies = time_source(source, args.layer, observers, args.radius)
+            print('{:<8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(name, latencies.mean(),
+                                                                    np.percentile(latencies, 50),
+                                                                    np.percentile(latencies, 95), latencies.max()))
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
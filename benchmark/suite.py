@@ -0,0 +1,165 @@
+"""
+Viewshed pipeline benchmark on synthetic DEMs, no GeoServer involved.
+
+Every case writes a synthetic DEM to an in-memory GeoTIFF and runs generating_viewshed on it, each stage is then
+timed on its own: reading the window, generating view lines, line of sight and polygonizing. Cases run in fresh
+interpreters so that peak memory belongs to one case only.
+
+    python -m benchmark.suite --output results.json
+    python -m benchmark.suite --baseline results.json --threshold 0.25
+
+With a baseline, the run fails when a stage of a case gets slower than the baseline by more than the threshold.
+"""
+import sys
+import json
+import time
+import argparse
+import itertools
+import subprocess
+from benchmark.memory import OBSERVER, get_peak_rss
+from benchmark.synthetic import DEMS, EARTH_RADIUS, get_geotransform, get_shape, dem2geotiff
+from mvc.modeller.properties import SWATH_MODES
+
+RESOLUTIONS = {
+    30: 1.0 / 3600,
+    10: 1.0 / 10800
+}
+STAGES = ('read', 'viewlines', 'visibility', 'polygonize', 'total')
+NOISE_FLOOR = 0.05  # seconds, stages faster than this are not checked for regressions
+
+
+def get_cases(dems, radii, swaths, resolutions, curvatures):
+    return [{"dem": dem, "radius": radius, "swath": swath, "resolution": resolution, "curvature": curvature}
+            for dem, radius, swath, resolution, curvature in itertools.product(dems, radii, swaths, resolutions,
+                                                                                curvatures)]
+
+
+def get_case_name(case):
+    swath = case['swath'] if case['swath'] in SWATH_MODES else '{:g}deg'.format(case['swath'])
+    return '{}/{:g}m/{}/{}m/{}'.format(case['dem'], case['radius'], swath, case['resolution'],
+                                      'curvature' if case['curvature'] else 'flat-earth')
+
+
+def timed(timings, stage, function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    timings[stage] = min(timings.get(stage, float('inf')), time.time() - start)
+    return result
+
+
+def run_case(case, engine, algorithm, repeat):
+    from osgeo import gdal
+    from mvc.modeller.algorithm import generating_viewshed, read_image, viewshed_bbox, transform_coords, \
+        calculate_viewlines, calculate_visibility, polygonize_array
+    pixel_size = RESOLUTIONS[case['resolution']]
+    shape = get_shape(OBSERVER, case['radius'], pixel_size)
+    geotiff = dem2geotiff(DEMS[case['dem']](shape), get_geotransform(OBSERVER, shape, pixel_size))
+    params = (1.7, 0.0, case['radius'], case['swath'], case['curvature'], case['curvature'], 0.13, True, EARTH_RADIUS,
+              False, engine, algorithm, 1)
+    before = get_peak_rss()
+    timings = dict()
+    try:
+        for i in range(repeat):
+            geotransform, matrix = timed(timings, 'read', read_image, geotiff,
+                                         viewshed_bbox(OBSERVER[0], OBSERVER[1], case['radius']))
+            viewpoint = transform_coords(geotransform, OBSERVER[0], OBSERVER[1])
+            viewlines = timed(timings, 'viewlines', calculate_viewlines, geotransform, OBSERVER, case['radius'], True,
+                              case['swath'], viewpoint, EARTH_RADIUS)
+            array = timed(timings, 'visibility', calculate_visibility, OBSERVER, *(params + (geotransform, matrix)))
+            vector = timed(timings, 'polygonize', polygonize_array, array, geotransform)
+            timed(timings, 'total', generating_viewshed, OBSERVER, *(params + (geotransform, matrix)))
+    finally:
+        gdal.Unlink(geotiff)
+    pixels = matrix.size
+    return {
+        "shape": list(matrix.shape),
+        "rays": len(viewlines),
+        "pixels": pixels,
+        "visible": int((array > 0).sum()),
+        "polygons": len(vector['features']),
+        "seconds": dict((stage, round(timings[stage], 4)) for stage in STAGES),
+        "rays_per_second": round(len(viewlines) / max(timings['visibility'], 1e-9), 1),
+        "pixels_per_second": round(pixels / max(timings['total'], 1e-9), 1),
+        "peak_mb": round(get_peak_rss(), 1),
+        "growth_mb": round(get_peak_rss() - before, 1)
+    }
+
+
+def run(cases, engine, algorithm, repeat):
+    results = dict()
+    for case in cases:
+        out = subprocess.check_output([sys.executable, '-m', 'benchmark.suite', '--case', json.dumps(case),
+                                       '--engine', engine, '--algorithm', algorithm, '--repeat', str(repeat)])
+        result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        result.update(case)
+        results[get_case_name(case)] = result
+        report(get_case_name(case), result)
+    return results
+
+
+def report(name, result):
+    print('{:<40}{:>9}{:>9}{:>9}{:>9}{:>9}{:>12}{:>14}{:>9}'.format(
+        name, *([result['seconds'][stage] for stage in STAGES] +
+                [result['rays_per_second'], result['pixels_per_second'], result['peak_mb']])))
+
+
+def compare(results, baseline, threshold):
+    regressions = list()
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for stage in STAGES:
+            before = baseline[name]['seconds'][stage]
+            after = result['seconds'][stage]
+            if after > NOISE_FLOOR and after > before * (1.0 + threshold):
+                regressions.append((name, stage, before, after))
+    return regressions
+
+
+def get_swath(value):
+    return value if value in SWATH_MODES else float(value)
+
+
+def split(values, cast):
+    return [cast(value) for value in values.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the viewshed pipeline on synthetic DEMs.')
+    parser.add_argument('--dems', default=','.join(sorted(DEMS.keys())), help='comma separated, flat, cone, ridge')
+    parser.add_argument('--radius', default='1000,5000', help='comma separated view distances (meter)')
+    parser.add_argument('--swath', default='0.15', help='comma separated azimuth steps (degree), auto or split')
+    parser.add_argument('--resolution', default='30,10', help='comma separated DEM resolutions, 10|30 meters')
+    parser.add_argument('--curvature', default='false,true', help='comma separated earth curvature flags')
+    parser.add_argument('--engine', default='numpy', choices=['numpy', 'loop', 'template'])
+    parser.add_argument('--algorithm', default='ray', choices=['ray', 'sweep'])
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the fastest one is kept')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown per stage, default to 25%%')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case), args.engine, args.algorithm, max(1, args.repeat))))
+        return
+    cases = get_cases(split(args.dems, str), split(args.radius, float), split(args.swath, get_swath),
+                      split(args.resolution, int), split(args.curvature, lambda value: value.lower() == 'true'))
+    print('{:<40}{:>9}{:>9}{:>9}{:>9}{:>9}{:>12}{:>14}{:>9}'.format('case', *(STAGES + ('rays/s', 'pixels/s',
+                                                                                       'peak MB'))))
+    results = run(cases, args.engine, args.algorithm, max(1, args.repeat))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"engine": args.engine, "algorithm": args.algorithm, "results": results}, f, indent=2,
+                      sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, stage, before, after in regressions:
+            print('REGRESSION {} {}: {:.4f}s -> {:.4f}s'.format(name, stage, before, after))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Agreement of the ring sweep with the ray engine on synthetic DEMs.
+
+Both algorithms run on the same DEM window for every case. Agreement is the share of cells reached by a ray within
+the view distance, the outermost ring left out, on which both find the same visibility: the sweep visits every cell
+while rays of the auto swath skip a few far from the observer. The sweep interpolates horizons from the ring before,
+so it is expected to differ from the rays on a few cells behind ridges.
+
+    python -m benchmark.sweep --dem flat,cone,ridge --radius 1000,5000 --threshold 0.97
+
+Exits with status 1 when a case agrees on less than the threshold.
+"""
+import sys
+import time
+import argparse
+import itertools
+import numpy as np
+from benchmark.memory import OBSERVER
+from benchmark.synthetic import DEMS, EARTH_RADIUS, get_geotransform, get_shape
+
+PIXEL_SIZE = 1.0 / 3600
+THRESHOLD = 0.97  # lowest agreement accepted
+
+
+def get_agreement(geotransform, rays, sweep, covered, radius):
+    # Cells are compared out to one cell short of the radius, where the two algorithms round the circle differently
+    rows, cols = np.mgrid[0:rays.shape[0], 0:rays.shape[1]]
+    pxh = (np.pi * abs(geotransform[5]) * EARTH_RADIUS) / 180.0
+    pxw = (np.pi * abs(geotransform[1]) * EARTH_RADIUS) / 180.0 * np.cos(np.radians(OBSERVER[1]))
+    d = np.hypot((cols - rays.shape[1] // 2) * pxw, (rows - rays.shape[0] // 2) * pxh)
+    inside = (d <= radius - max(pxw, pxh)) & covered
+    return float(np.mean((rays[inside] > 0) == (sweep[inside] > 0)))
+
+
+def run_case(dem, radius, curvature, height):
+    from mvc.modeller.algorithm import calculate_visibility
+    shape = get_shape(OBSERVER, radius, PIXEL_SIZE)
+    geotransform = get_geotransform(OBSERVER, shape, PIXEL_SIZE)
+    matrix = DEMS[dem](shape)
+    result = {"dem": dem, "radius": radius, "curvature": curvature}
+    for algorithm in ('ray', 'sweep'):
+        start = time.time()
+        result[algorithm] = calculate_visibility(OBSERVER, height, 0.0, radius, 'auto', curvature, curvature, 0.13,
+                                                 True, EARTH_RADIUS, False, 'numpy', algorithm, 1, geotransform,
+                                                 matrix)
+        result[algorithm + '_seconds'] = time.time() - start
+    # On a flat DEM every cell a ray reaches is visible
+    covered = calculate_visibility(OBSERVER, height, 0.0, radius, 'auto', False, False, 0.13, True, EARTH_RADIUS,
+                                   False, 'numpy', 'ray', 1, geotransform, DEMS['flat'](shape)) > 0
+    result['agreement'] = get_agreement(geotransform, result['ray'], result['sweep'], covered, radius)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the ring sweep with the ray engine.')
+    parser.add_argument('--dem', default='flat,cone,ridge', help='comma separated synthetic DEMs')
+    parser.add_argument('--radius', default='1000,5000', help='comma separated view distances (meter)')
+    parser.add_argument('--height', type=float, default=1.7, help='observer height from ground (meter)')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='lowest agreement accepted, from 0 to 1')
+    args = parser.parse_args()
+    dems = args.dem.split(',')
+    for dem in dems:
+        if dem not in DEMS:
+            parser.error('unknown DEM %s, choose from %s' % (dem, ', '.join(sorted(DEMS))))
+    failures = list()
+    print('{:<8}{:>10}{:>12}{:>10}{:>10}{:>10}{:>10}{:>12}'.format('dem', 'radius m', 'curvature', 'ray s', 'sweep s',
+                                                                 'ray vis', 'sweep vis', 'agreement'))
+    for dem, radius, curvature in itertools.product(dems, [float(value) for value in args.radius.split(',')],
+                                                    (False, True)):
+        result = run_case(dem, radius, curvature, args.height)
+        ok = result['agreement'] >= args.threshold
+        print('{:<8}{:>10g}{:>12}{:>10.3f}{:>10.3f}{:>10}{:>10}{:>11.2f}%{}'.format(
+            dem, radius, str(curvature), result['ray_seconds'], result['sweep_seconds'],
+            int(np.count_nonzero(result['ray'])), int(np.count_nonzero(result['sweep'])),
+            result['agreement'] * 100.0, '' if ok else '  FAILED'))
+        if not ok:
+            failures.append(result)
+    if failures:
+        print('%s of the cases agree on less than %.2f%% of their cells' % (len(failures), args.threshold * 100.0))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import math
+import uuid
+import numpy as np
+
+EARTH_RADIUS = 6371000.0
+
+
+def get_geotransform(observer, shape, pixel_size):
+    # The observer sits at the center of the middle pixel, as a snapped viewshed request would
+    rows, cols = shape
+    return (observer[0] - (cols // 2 + 0.5) * pixel_size, pixel_size, 0.0,
+            observer[1] + (rows // 2 + 0.5) * pixel_size, 0.0, -pixel_size)
+
+
+def get_shape(observer, radius, pixel_size, earth_radius=EARTH_RADIUS):
+    pxh = (math.pi * pixel_size * earth_radius) / 180.0
+    pxw = pxh * math.cos(math.radians(observer[1]))
+    return 2 * int(math.ceil(radius / pxh)) + 3, 2 * int(math.ceil(radius / pxw)) + 3
+
+
+def flat_dem(shape, height=100.0):
+    return np.full(shape, height, dtype=np.float32)
+
+
+def cone_dem(shape, height=500.0, slope=1.0):
+    y, x = np.ogrid[0:shape[0], 0:shape[1]]
+    return (height - slope * np.hypot(x - shape[1] // 2, y - shape[0] // 2)).astype(np.float32)
+
+
+def ridge_dem(shape, relief=300.0, beta=3.0, seed=0):
+    # Fractal surface from 1/f^beta filtered noise, folded into ridges by taking the absolute value
+    rs = np.random.RandomState(seed)
+    fy = np.fft.fftfreq(shape[0])[:, np.newaxis]
+    fx = np.fft.rfftfreq(shape[1])[np.newaxis, :]
+    f = np.hypot(fx, fy)
+    f[0, 0] = 1.0
+    spectrum = (rs.randn(*f.shape) + 1j * rs.randn(*f.shape)) / np.power(f, beta / 2.0)
+    spectrum[0, 0] = 0.0
+    surface = np.fft.irfft2(spectrum, shape)
+    surface = 1.0 - np.abs(surface / np.abs(surface).max())
+    return (relief * surface).astype(np.float32)
+
+
+DEMS = {
+    'flat': flat_dem,
+    'cone': cone_dem,
+    'ridge': ridge_dem
+}
+
+
+def dem2geotiff(dem, geotransform):
+    # In-memory GeoTIFF standing in for a GeoServer coverage, remove it with gdal.Unlink once done
+    from osgeo import gdal
+    from mvc.modeller.algorithm import array2raster
+    geotiff = '/vsimem/synthetic-' + str(uuid.uuid4()) + '.tif'
+    array2raster(geotiff, (geotransform[0], geotransform[3]), geotransform[1], geotransform[5], dem,
+                 gdal.GDT_Float32)
+    return geotiff
@@ -0,0 +1,85 @@
+"""
+Startup and first request latency of cold and warm workers.
+
+A cold worker imports the app and builds its GDAL state on the first request. A warm worker also runs warm_up, the
+way the gunicorn master does before forking, and preloads the DEM region of the requests. Every mode runs in a fresh
+interpreter against a synthetic DEM read from disk through the local DEM source, through the Flask test client.
+
+    python -m benchmark.warm --requests 5
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from benchmark.sources import CENTER, write_dem
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ('cold', 'warm')
+SIZE = 1440
+PIXEL_SIZE = 1.0 / 3600
+
+
+def run_mode(mode, requests, radius):
+    start = time.time()
+    from viewshed import app
+    if mode == 'warm':
+        from mvc.modeller.warm import warm_up, after_fork
+        warm_up()
+        after_fork()
+    startup = time.time() - start
+    client = app.test_client()
+    latencies = list()
+    for i in range(requests):
+        # A new observer every time, the results cache must not answer
+        url = '/gdal/wps/viewshed?coordinates=%s,%s&distance=%s' % (CENTER[0] + i * 0.001, CENTER[1], radius)
+        start = time.time()
+        response = client.get(url)
+        latencies.append(time.time() - start)
+        if response.status_code != 200:
+            raise RuntimeError('%s answered %s' % (url, response.status_code))
+    return {"startup": startup, "first": latencies[0], "steady": min(latencies[1:] or latencies)}
+
+
+def run(folder, path, mode, requests, radius):
+    env = dict(os.environ, PYTHONPATH=ROOT, DEM_SOURCE='local', DEM_30METERS_PATH=path)
+    env.pop('DEM_PRELOAD_BBOX', None)
+    if mode == 'warm':
+        half = SIZE * PIXEL_SIZE / 2.0
+        env['DEM_PRELOAD_BBOX'] = '%s,%s,%s,%s' % (CENTER[0] - half, CENTER[1] - half, CENTER[0] + half,
+                                                   CENTER[1] + half)
+    out = subprocess.check_output([sys.executable, '-m', 'benchmark.warm', '--mode', mode, '--requests',
+                                   str(requests), '--radius', str(radius)], cwd=folder, env=env)
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare startup and first request latency of cold and warm workers.')
+    parser.add_argument('--requests', type=int, default=5, help='requests per worker, the first one is reported alone')
+    parser.add_argument('--radius', type=float, default=1000.0)
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, max(1, args.requests), args.radius)))
+        return
+    folder = tempfile.mkdtemp(prefix='viewshed-warm-')
+    try:
+        # viewshed.py reads logging.conf and writes ./log/viewshed.log from the working directory
+        shutil.copy(os.path.join(ROOT, 'logging.conf'), folder)
+        os.mkdir(os.path.join(folder, 'log'))
+        path = os.path.join(folder, 'dem.tif')
+        write_dem(path, SIZE, PIXEL_SIZE)
+        print('{:<8}{:>12}{:>12}{:>12}'.format('worker', 'startup ms', 'first ms', 'steady ms'))
+        for mode in MODES:
+            result = run(folder, path, mode, args.requests, args.radius)
+            print('{:<8}{:>12.1f}{:>12.1f}{:>12.1f}'.format(mode, result['startup'] * 1000.0,
+                                                            result['first'] * 1000.0, result['steady'] * 1000.0))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
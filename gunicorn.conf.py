@@ -0,0 +1,24 @@
+"""
+Warm workers, the app and its GDAL state are loaded once in the master and forked into the workers.
+
+    gunicorn -c gunicorn.conf.py -b 0.0.0.0:4000 viewshed:app
+"""
+import os
+import multiprocessing
+
+preload_app = True
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+# Single threaded sync workers rather than gthread or gevent: batch, cumulative and parallel sector viewsheds fork
+# process pools from the request, and a child forked while another request thread holds a lock (logging, metrics,
+# the slope buffers) would wait on it forever. Concurrency comes from the number of workers.
+worker_class = 'sync'
+
+
+def when_ready(server):
+    from mvc.modeller.warm import warm_up
+    warm_up()
+
+
+def post_fork(server, worker):
+    from mvc.modeller.warm import after_fork
+    after_fork()
@@ -1,11 +1,21 @@
+import base64
+import json
+import urllib
 import logging
-from flask import request
-from mvc.modeller import ViewShed
+from flask import request, Response
+from mvc.modeller import ViewShed, BatchViewShed, CumulativeViewShed
+from setting import BATCH_MAX_OBSERVERS, SECTOR_MAX_WORKERS, RESULT_CACHE_ENABLED, TILE_SIZE, TILE_COLOR, \
+    VIEWSHED_MIN_DISTANCE, VIEWSHED_MAX_DISTANCE, PYRAMID_MAX_DISTANCE, PYRAMID_BASE_DISTANCE, BATCH_MAX_PIXELS
 from flask_restplus import Resource
-from mvc.controller.schema import wps
+from mvc.controller.schema import wps, cache, result_cache, viewshed_batch, viewshed_cumulative, job
 from mvc.controller.flaskapi import api
 from mvc.modeller import ServiceRegister
-from mvc.modeller.validator import validate_coords
+from mvc.modeller.cache import dem_cache, result_cache as viewshed_cache
+from mvc.modeller.jobs import job_queue
+from mvc.modeller.algorithm import stream_feature_collection, stream_feature_sequence, stream_gzip, viewshed_bbox, \
+    render_tile, get_feature_collection
+from mvc.modeller.properties import PROP_DEFAULT
+from mvc.modeller.validator import validate_coords, validate_swath
 from mvc.controller.parser import viewshed_arguments
 from mvc.controller.parser.label import VIEWSHED_LABEL
 
@@ -13,6 +23,168 @@ ns = api.namespace('wps', description='Perform web spatial analysis')
 log = logging.getLogger(__name__)
 
 
+def parse_viewshed(args):
+    coordinates = args.get(VIEWSHED_LABEL['coordinates'])
+    distance = args.get(VIEWSHED_LABEL['distance'], 1000.0)
+    height = args.get(VIEWSHED_LABEL['height'], 1.70)
+    offset = args.get(VIEWSHED_LABEL['offset'])
+    swath = args.get(VIEWSHED_LABEL['swath'])
+    curvature = args.get(VIEWSHED_LABEL['curvature'])
+    refraction = args.get(VIEWSHED_LABEL['refraction'])
+    k = args.get(VIEWSHED_LABEL['k'])
+    use_swath = args.get(VIEWSHED_LABEL['use_swath'])
+    earth_radius = args.get(VIEWSHED_LABEL['earth_radius'])
+    resolution = args.get(VIEWSHED_LABEL['resolution'])
+    esri = args.get(VIEWSHED_LABEL['esri'])
+    engine = args.get(VIEWSHED_LABEL['engine'])
+    algorithm = args.get(VIEWSHED_LABEL['algorithm'])
+    workers = args.get(VIEWSHED_LABEL['workers'])
+    simplify = args.get(VIEWSHED_LABEL['simplify'])
+    min_area = args.get(VIEWSHED_LABEL['min_area'])
+    precision = args.get(VIEWSHED_LABEL['precision'])
+    pyramid = args.get(VIEWSHED_LABEL['pyramid'])
+    if args.get('distance') is not None:
+        distance = args.get('distance')
+    if args.get('height') is not None:
+        height = args.get('height')
+    if args.get('offset') is not None:
+        offset = args.get('offset')
+    if args.get('swath') is not None:
+        swath = args.get('swath')
+    if args.get('curvature') is not None:
+        curvature = args.get('curvature')
+    if args.get('refraction') is not None:
+        refraction = args.get('refraction')
+    if args.get('k') is not None:
+        k = args.get('k')
+    if args.get('use_swath') is not None:
+        use_swath = args.get('use_swath')
+    if args.get('earth_radius') is not None:
+        earth_radius = args.get('earth_radius')
+    if args.get('resolution') is not None:
+        resolution = args.get('resolution')
+    if args.get('esri') is not None:
+        esri = args.get('esri')
+    if args.get('engine') is not None:
+        engine = args.get('engine')
+    if args.get('algorithm') is not None:
+        algorithm = args.get('algorithm')
+    if args.get('workers') is not None:
+        workers = max(1, min(args.get('workers'), SECTOR_MAX_WORKERS))
+    if args.get('simplify') is not None:
+        simplify = max(0.0, args.get('simplify'))
+    if args.get('min_area') is not None:
+        min_area = max(0.0, args.get('min_area'))
+    if args.get('precision') is not None:
+        precision = max(0, min(args.get('precision'), 15))
+    if args.get('pyramid') is not None:
+        pyramid = args.get('pyramid')
+    max_distance = PYRAMID_MAX_DISTANCE if pyramid else VIEWSHED_MAX_DISTANCE
+    if not validate_swath(swath):
+        return None, {"message": "swath must be a positive angle in degree, auto or split"}
+    if ',' in coordinates:
+        if validate_coords(coordinates):
+            if VIEWSHED_MIN_DISTANCE <= distance <= max_distance:
+                x = float(coordinates.split(',')[0])
+                y = float(coordinates.split(',')[1])
+                viewshed = ViewShed(x=x, y=y, distance=distance, height=height, offset=offset, swath=swath,
+                                    curvature=curvature, refraction=refraction, k=k, use_swath=use_swath,
+                                    earth_radius=earth_radius, resolution=resolution, esri=esri,
+                                    engine=engine, algorithm=algorithm, workers=workers, simplify=simplify,
+                                    min_area=min_area, precision=precision, pyramid=pyramid)
+                if pyramid and distance > PYRAMID_BASE_DISTANCE and not viewshed.is_local():
+                    return None, {"message": "pyramid viewsheds past %s m need a local or preloaded DEM" %
+                                             PYRAMID_BASE_DISTANCE}
+                return viewshed, None
+            else:
+                return None, {"message": "view distance must be between %s and %s" % (VIEWSHED_MIN_DISTANCE,
+                                                                                      max_distance)}
+        else:
+            return None, {"message": "invalid literal for coordinates"}
+    else:
+        return None, {"message": "longitude and latitude must be comma separated"}
+
+
+def stream_response(features, vertices, levels, output, headers):
+    if output == 'geojsonseq':
+        chunks, mimetype = stream_feature_sequence(features), 'application/geo+json-seq'
+    else:
+        chunks, mimetype = stream_feature_collection(features, vertices, levels), 'application/geo+json'
+    return chunked_response(chunks, mimetype, headers)
+
+
+def cache_features(key, features, vertices, levels):
+    # Features are collected on their way to the client and cached as the document analysis would return, once the
+    # last one went through. A response the client leaves early is not cached.
+    collected = list()
+    for feature in features:
+        collected.append(feature)
+        yield feature
+    viewshed_cache.put(key, get_feature_collection(collected, vertices, levels))
+
+
+def cached_stream_response(data, output, headers):
+    # A cached document is sent as it is, only the feature sequence is rebuilt from it
+    if output == 'geojsonseq':
+        return stream_response(iter(json.loads(data)['features']), None, None, output, headers)
+    return chunked_response(iter([data]), 'application/geo+json', headers)
+
+
+def chunked_response(chunks, mimetype, headers):
+    headers = dict(headers)
+    headers['Vary'] = 'Accept-Encoding'
+    if 'gzip' in request.accept_encodings:
+        chunks = stream_gzip(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+
+def raster_response(viewshed, output):
+    if not RESULT_CACHE_ENABLED:
+        if output == 'tiles':
+            return {"message": "tiles require the result cache to be enabled"}
+        geotiff = viewshed.raster()
+        return geotiff if geotiff is None else Response(geotiff, mimetype='image/tiff')
+    key, geotiff = cached_raster(viewshed, output == 'raster')
+    headers = {'ETag': '"%s"' % key}
+    if geotiff == 304:
+        return Response(status=304, headers=headers)
+    if geotiff is None:
+        return geotiff
+    if output == 'tiles':
+        # Tile URLs carry the viewshed arguments, so that any worker can serve them: from its own cache or the disk
+        # tier when the raster is there, computing it again otherwise
+        args = [(name, value) for name, value in request.args.items(multi=True)
+                if name not in (VIEWSHED_LABEL['output'], VIEWSHED_LABEL['stream'])]
+        url = api.url_for(ViewshedTileMethod, z=0, x=0, y=0, _external=True)
+        min_x, min_y, max_x, max_y = viewshed_bbox(viewshed.x, viewshed.y, viewshed.distance)
+        return {
+            "tilejson": "2.2.0",
+            "tiles": [url[:-len('0/0/0.png')] + '{z}/{x}/{y}.png?' + urllib.urlencode(args)],
+            "bounds": [min_x, min_y, max_x, max_y],
+            "center": [viewshed.x, viewshed.y]
+        }
+    return Response(geotiff, mimetype='image/tiff', headers=headers)
+
+
+def cached_raster(viewshed, conditional=False):
+    # Returns the cache key and the GeoTIFF of the viewshed, computed once and cached next to the vector results,
+    # base64 encoded since cached results are JSON documents. The GeoTIFF is 304 when conditional and the client
+    # already holds it.
+    viewshed.snap()
+    key = viewshed_cache.etag(dict(viewshed.cache_key(), output='raster'))
+    if conditional and key in request.if_none_match:
+        return key, 304
+    result = viewshed_cache.get(key)
+    if result is None:
+        geotiff = viewshed.raster()
+        if geotiff is None:
+            return key, geotiff
+        viewshed_cache.put(key, {"geotiff": base64.b64encode(geotiff)})
+        return key, geotiff
+    return key, base64.b64decode(json.loads(result)['geotiff'])
+
+
 @ns.route('/')
 class GetWPSCapabilities(Resource):
     @api.marshal_list_with(wps)
@@ -24,61 +196,231 @@ class GetWPSCapabilities(Resource):
         return ServiceRegister().services
 
 
+@ns.route('/cache')
+class DemCacheStatistics(Resource):
+    @api.marshal_with(cache)
+    def get(self):
+        """
+        Returns DEM tile cache statistics.
+        """
+        return dem_cache.stats()
+
+
+@ns.route('/cache/results')
+class ResultCacheStatistics(Resource):
+    @api.marshal_with(result_cache)
+    def get(self):
+        """
+        Returns viewshed result cache statistics.
+        """
+        return viewshed_cache.stats()
+
+
 @ns.route('/viewshed')
 class ViewshedMethod(Resource):
     @api.expect(viewshed_arguments, validate=True)
     @api.response(201, 'Viewshed successfully created!')
+    @api.response(304, 'Viewshed not modified')
     def get(self):
         """
         Returns viewshed analysis result.
         """
         args = viewshed_arguments.parse_args(request)
-        coordinates = args.get(VIEWSHED_LABEL['coordinates'])
-        distance = args.get(VIEWSHED_LABEL['distance'], 1000.0)
-        height = args.get(VIEWSHED_LABEL['height'], 1.70)
-        offset = args.get(VIEWSHED_LABEL['offset'])
-        swath = args.get(VIEWSHED_LABEL['swath'])
-        curvature = args.get(VIEWSHED_LABEL['curvature'])
-        refraction = args.get(VIEWSHED_LABEL['refraction'])
-        k = args.get(VIEWSHED_LABEL['k'])
-        use_swath = args.get(VIEWSHED_LABEL['use_swath'])
-        earth_radius = args.get(VIEWSHED_LABEL['earth_radius'])
-        resolution = args.get(VIEWSHED_LABEL['resolution'])
-        esri = args.get(VIEWSHED_LABEL['esri'])
-        if args.get('distance') is not None:
-            distance = args.get('distance')
-        if args.get('height') is not None:
-            height = args.get('height')
-        if args.get('offset') is not None:
-            offset = args.get('offset')
-        if args.get('swath') is not None:
-            swath = args.get('swath')
-        if args.get('curvature') is not None:
-            curvature = args.get('curvature')
-        if args.get('refraction') is not None:
-            refraction = args.get('refraction')
-        if args.get('k') is not None:
-            k = args.get('k')
-        if args.get('use_swath') is not None:
-            use_swath = args.get('use_swath')
-        if args.get('earth_radius') is not None:
-            earth_radius = args.get('earth_radius')
-        if args.get('resolution') is not None:
-            resolution = args.get('resolution')
-        if args.get('esri') is not None:
-            esri = args.get('esri')
-        if ',' in coordinates:
-            if validate_coords(coordinates):
-                if 500.0 <= distance <= 5000.0:
-                    x = float(coordinates.split(',')[0])
-                    y = float(coordinates.split(',')[1])
-                    viewshed = ViewShed(x=x, y=y, distance=distance, height=height, offset=offset, swath=swath,
-                                        curvature=curvature, refraction=refraction, k=k, use_swath=use_swath,
-                                        earth_radius=earth_radius, resolution=resolution, esri=esri)
+        viewshed, message = parse_viewshed(args)
+        if viewshed is None:
+            return message
+        output = args.get(VIEWSHED_LABEL['output']) or 'geojson'
+        if output in ('raster', 'tiles'):
+            if viewshed.pyramid:
+                return {"message": "pyramid viewsheds are only available as geojson or geojsonseq"}
+            return raster_response(viewshed, output)
+        stream = output == 'geojsonseq' or args.get(VIEWSHED_LABEL['stream'])
+        if not RESULT_CACHE_ENABLED:
+            if stream:
+                streamed = viewshed.stream()
+                return streamed if streamed is None else stream_response(streamed[0], streamed[1], streamed[2],
+                                                                         output, {})
+            return viewshed.analysis()
+        # Observers are snapped to DEM pixel centers so that near-identical clicks share one entry, the result is a
+        # function of the key alone, so a matching ETag can be answered without looking the result up
+        viewshed.snap()
+        key = viewshed_cache.etag(viewshed.cache_key())
+        etag = key
+        if stream:
+            # each streamed representation gets its own tag, they are not byte-identical to the cached document
+            etag = '%s-%s' % (key, output + ('-gzip' if 'gzip' in request.accept_encodings else ''))
+        headers = {'ETag': '"%s"' % etag}
+        if etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+        data = viewshed_cache.get(key)
+        if stream:
+            # a cached result is replayed, otherwise features are streamed and cached once they all went through
+            if data is not None:
+                return cached_stream_response(data, output, headers)
+            streamed = viewshed.stream()
+            if streamed is None:
+                return streamed
+            features, vertices, levels = streamed
+            return stream_response(cache_features(key, features, vertices, levels), vertices, levels, output,
+                                   headers)
+        if data is None:
+            result = viewshed.analysis()
+            if result is None:
+                return result
+            data = viewshed_cache.put(key, result)
+        return Response(data, mimetype='application/json', headers=headers)
+
+
+@ns.route('/viewshed/tiles/<int:z>/<int:x>/<int:y>.png')
+class ViewshedTileMethod(Resource):
+    @api.expect(viewshed_arguments, validate=True)
+    @api.response(200, 'PNG tile')
+    @api.response(404, 'Tile out of range')
+    def get(self, z, x, y):
+        """
+        Returns an XYZ PNG tile of a viewshed raster, visible cells are colored and the rest is transparent. Takes the
+        viewshed arguments, as in the tile URL of the TileJSON document returned by output=tiles.
+        """
+        if not 0 <= x < pow(2, z) or not 0 <= y < pow(2, z):
+            api.abort(404, 'tile %s/%s/%s out of range' % (z, x, y))
+        if not RESULT_CACHE_ENABLED:
+            return {"message": "tiles require the result cache to be enabled"}
+        viewshed, message = parse_viewshed(viewshed_arguments.parse_args(request))
+        if viewshed is None:
+            return message
+        if viewshed.pyramid:
+            return {"message": "pyramid viewsheds are only available as geojson or geojsonseq"}
+        viewshed.snap()
+        key = viewshed_cache.etag(dict(viewshed.cache_key(), output='raster'))
+        etag = '%s-%s-%s-%s' % (key, z, x, y)
+        headers = {'ETag': '"%s"' % etag}
+        if etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+        key, geotiff = cached_raster(viewshed)
+        if geotiff is None:
+            return geotiff
+        png = render_tile(geotiff, z, x, y, TILE_SIZE, TILE_COLOR)
+        return Response(png, mimetype='image/png', headers=headers)
+
+
+@ns.route('/viewshed/jobs')
+class ViewshedJobMethod(Resource):
+    @api.expect(viewshed_arguments, validate=True)
+    @api.response(202, 'Viewshed job accepted!')
+    @api.response(429, 'Too many queued jobs, retry later')
+    def post(self):
+        """
+        Queues a viewshed analysis and returns its job id.
+        """
+        viewshed, message = parse_viewshed(viewshed_arguments.parse_args(request))
+        if viewshed is None:
+            return message, 400
+        queued = job_queue.submit(viewshed)
+        if queued is None:
+            return {"message": "too many queued jobs, retry later"}, 429
+        return queued.state(), 202
+
+
+@ns.route('/viewshed/jobs/<string:job_id>')
+class ViewshedJobStatus(Resource):
+    @api.marshal_with(job)
+    @api.response(404, 'Job not found')
+    def get(self, job_id):
+        """
+        Returns status and progress of a viewshed job.
+        """
+        queued = job_queue.get(job_id)
+        if queued is None:
+            api.abort(404, 'job %s not found' % job_id)
+        return queued.state()
+
+
+@ns.route('/viewshed/jobs/<string:job_id>/result')
+class ViewshedJobResult(Resource):
+    @api.response(404, 'Job not found')
+    @api.response(409, 'Job not finished')
+    def get(self, job_id):
+        """
+        Returns viewshed analysis result of a finished job.
+        """
+        queued = job_queue.get(job_id)
+        if queued is None:
+            api.abort(404, 'job %s not found' % job_id)
+        if queued.status != 'finished':
+            return queued.state(), 409
+        return queued.result
+
+
+@ns.route('/viewshed/batch')
+class ViewshedBatchMethod(Resource):
+    @api.expect(viewshed_batch, validate=True)
+    @api.response(201, 'Viewsheds successfully created!')
+    def post(self):
+        """
+        Returns viewshed analysis results for many observers sharing one DEM, one feature per observer.
+        """
+        payload = api.payload
+        kwargs = dict()
+        for prop in PROP_DEFAULT:
+            if payload.get(prop) is not None:
+                kwargs[prop] = payload.get(prop)
+        observers = payload.get('coordinates')
+        distance = kwargs.get('distance', PROP_DEFAULT['distance'])
+        if not validate_swath(kwargs.get('swath', PROP_DEFAULT['swath'])):
+            return {"message": "swath must be a positive angle in degree, auto or split"}
+        if 1 <= len(observers) <= BATCH_MAX_OBSERVERS:
+            if all(len(observer) == 2 for observer in observers):
+                if VIEWSHED_MIN_DISTANCE <= distance <= VIEWSHED_MAX_DISTANCE:
+                    viewshed = BatchViewShed(observers=[(float(x), float(y)) for x, y in observers], **kwargs)
+                    pixels = viewshed.union_pixels()
+                    if pixels > BATCH_MAX_PIXELS:
+                        return {"message": "observers span %s DEM pixels, at most %s in one batch, split the batch" %
+                                           (pixels, BATCH_MAX_PIXELS)}
                     return viewshed.analysis()
                 else:
-                    return {"message": "view distance must be between 500.0 and 5000.0"}
+                    return {"message": "view distance must be between %s and %s" % (VIEWSHED_MIN_DISTANCE,
+                                                                                      VIEWSHED_MAX_DISTANCE)}
+            else:
+                return {"message": "invalid literal for coordinates"}
+        else:
+            return {"message": "number of observers must be between 1 and %s" % BATCH_MAX_OBSERVERS}
+
+
+@ns.route('/viewshed/cumulative')
+class ViewshedCumulativeMethod(Resource):
+    @api.expect(viewshed_cumulative, validate=True)
+    @api.response(201, 'Cumulative viewshed successfully created!')
+    def post(self):
+        """
+        Returns how many observers see each cell, as classed polygons or a GeoTIFF.
+        """
+        payload = api.payload
+        kwargs = dict()
+        for prop in PROP_DEFAULT:
+            if payload.get(prop) is not None:
+                kwargs[prop] = payload.get(prop)
+        observers = payload.get('coordinates')
+        output = payload.get('output') or 'geojson'
+        distance = kwargs.get('distance', PROP_DEFAULT['distance'])
+        if not validate_swath(kwargs.get('swath', PROP_DEFAULT['swath'])):
+            return {"message": "swath must be a positive angle in degree, auto or split"}
+        if 1 <= len(observers) <= BATCH_MAX_OBSERVERS:
+            if all(len(observer) == 2 for observer in observers):
+                if VIEWSHED_MIN_DISTANCE <= distance <= VIEWSHED_MAX_DISTANCE:
+                    viewshed = CumulativeViewShed(observers=[(float(x), float(y)) for x, y in observers],
+                                                  output=output, **kwargs)
+                    pixels = viewshed.union_pixels()
+                    if pixels > BATCH_MAX_PIXELS:
+                        return {"message": "observers span %s DEM pixels, at most %s in one batch, split the batch" %
+                                           (pixels, BATCH_MAX_PIXELS)}
+                    result = viewshed.analysis()
+                    if output == 'geotiff' and result is not None:
+                        return Response(result, mimetype='image/tiff')
+                    return result
+                else:
+                    return {"message": "view distance must be between %s and %s" % (VIEWSHED_MIN_DISTANCE,
+                                                                                      VIEWSHED_MAX_DISTANCE)}
             else:
                 return {"message": "invalid literal for coordinates"}
         else:
-            return {"message": "longitude and latitude must be comma separated"}
+            return {"message": "number of observers must be between 1 and %s" % BATCH_MAX_OBSERVERS}
@@ -1,19 +1,32 @@
 from label import VIEWSHED_LABEL
-from flask_restplus import reqparse
+from flask_restplus import reqparse, inputs
+from mvc.modeller.properties import SWATH_MODES
+from setting import VIEWSHED_MIN_DISTANCE, VIEWSHED_MAX_DISTANCE, PYRAMID_MAX_DISTANCE, PYRAMID_BASE_DISTANCE
+
+
+def swath_type(value):
+    if value in SWATH_MODES:
+        return value
+    return float(value)
+
 
 viewshed_arguments = reqparse.RequestParser()
 viewshed_arguments.add_argument(VIEWSHED_LABEL['coordinates'], type=str, required=True,
                                 help='longitude, latitude', location='args')
 viewshed_arguments.add_argument(VIEWSHED_LABEL['distance'], type=float, required=False, default=1000.0,
-                                help='view distance (meter), default to 1000.0, minimum to 500.0, maximum to 5000.0',
-                                location='args')
+                                help='view distance (meter), default to 1000.0, minimum to %s, maximum to %s, or to %s '
+                                     'with pyramid' % (VIEWSHED_MIN_DISTANCE, VIEWSHED_MAX_DISTANCE,
+                                                       PYRAMID_MAX_DISTANCE), location='args')
 viewshed_arguments.add_argument(VIEWSHED_LABEL['height'], type=float, required=False, default=1.70,
                                 help='observer height from ground (meter), default to 1.70', location='args')
 viewshed_arguments.add_argument(VIEWSHED_LABEL['offset'], type=float, required=False, default=0.0,
                                 help='target offset from ground (meter), default to 0.0', location='args')
-viewshed_arguments.add_argument(VIEWSHED_LABEL['swath'], type=float, required=False, default=0.15,
+viewshed_arguments.add_argument(VIEWSHED_LABEL['swath'], type=swath_type, required=False, default=0.15,
                                 help='azimuth step range (angle in degree), such as 360/0.15 = 2400 steps, '
-                                     'default to 0', location='args')
+                                     'default to 0.15. auto uses the largest step that still reaches every cell '
+                                     'of the outer ring, split starts with fewer rays and doubles them every time '
+                                     'the distance doubles (numpy only, ignores engine and workers)',
+                                location='args')
 viewshed_arguments.add_argument(VIEWSHED_LABEL['curvature'], type=bool, required=False, default=False,
                                 help='considering earth curvature (false or true), default to false', location='args')
 viewshed_arguments.add_argument(VIEWSHED_LABEL['refraction'], type=bool, required=False, default=False,
@@ -36,3 +49,47 @@ viewshed_arguments.add_argument(VIEWSHED_LABEL['esri'], type=bool, required=Fals
                                 help="ESRI's method to calculate earth curvature (false or true), default to false, "
                                      "require curvature to be set to true",
                                 location='args')
+viewshed_arguments.add_argument(VIEWSHED_LABEL['engine'], type=str, required=False, default='numpy',
+                                choices=('numpy', 'loop', 'template'),
+                                help='line of sight engine (numpy, loop or template), default to numpy, the loop '
+                                     'engine walks each ray pixel by pixel and is kept for comparison, the template '
+                                     'engine reuses cached rays shared by observers at similar latitudes',
+                                location='args')
+viewshed_arguments.add_argument(VIEWSHED_LABEL['algorithm'], type=str, required=False, default='ray',
+                                choices=('ray', 'sweep'),
+                                help='viewshed algorithm (ray or sweep), default to ray. The sweep algorithm visits '
+                                     'each cell within the view distance once, ring by ring, and ignores swath, '
+                                     'use_swath and engine', location='args')
+viewshed_arguments.add_argument(VIEWSHED_LABEL['workers'], type=int, required=False, default=1,
+                                help='worker processes sharing the rays of one viewshed, default to 1, maximum to '
+                                     'the number of cores, only used by the ray algorithm with the numpy engine',
+                                location='args')
+viewshed_arguments.add_argument(VIEWSHED_LABEL['output'], type=str, required=False, default='geojson',
+                                choices=('geojson', 'geojsonseq', 'raster', 'tiles'),
+                                help='output format (geojson, geojsonseq, raster or tiles), default to geojson. '
+                                     'geojsonseq is a GeoJSON text sequence (RFC 8142) with one feature per record '
+                                     'and is always streamed. raster returns the visibility as a cloud optimized '
+                                     'GeoTIFF (0 hidden, 1 visible), tiles returns a TileJSON document pointing to '
+                                     'XYZ PNG tiles of that raster, both skip polygonization', location='args')
+viewshed_arguments.add_argument(VIEWSHED_LABEL['stream'], type=inputs.boolean, required=False, default=False,
+                                help='stream features with chunked transfer as they are converted to GeoJSON, once '
+                                     'polygonization is done (false or true), default to false, gzip compressed when '
+                                     'the client accepts it', location='args')
+viewshed_arguments.add_argument(VIEWSHED_LABEL['simplify'], type=float, required=False, default=0.0,
+                                help='polygon simplification tolerance (meter), default to 0.0 (no simplification), '
+                                     'simplified polygons keep a valid topology', location='args')
+viewshed_arguments.add_argument(VIEWSHED_LABEL['min_area'], type=float, required=False, default=0.0,
+                                help='polygons smaller than this area (square meter) are dropped, default to 0.0',
+                                location='args')
+viewshed_arguments.add_argument(VIEWSHED_LABEL['precision'], type=int, required=False,
+                                help='decimal places of coordinates, from 0 to 15, default to full precision',
+                                location='args')
+viewshed_arguments.add_argument(VIEWSHED_LABEL['pyramid'], type=inputs.boolean, required=False, default=False,
+                                help='multi-resolution viewshed for long view distances (false or true), default to '
+                                     'false. The DEM is used at full resolution near the observer, each further ring '
+                                     'doubles both the cell size and the distance, with the highest ground of every '
+                                     'cell so that coarse rings never lower the horizon. The response lists every '
+                                     'level with its cell size, relief bias and timings. Uses the auto swath, '
+                                     'ignores swath, use_swath, engine, algorithm and workers, geojson and geojsonseq '
+                                     'outputs only. Past %s m the DEM must be local or preloaded, it is not downloaded '
+                                     'through WCS' % PYRAMID_BASE_DISTANCE, location='args')
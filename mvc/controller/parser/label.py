@@ -10,5 +10,14 @@ VIEWSHED_LABEL = {
     "use_swath": 'use_swath',
     "earth_radius": 'earth_radius',
     "resolution": 'resolution',
-    "esri": 'esri'
+    "esri": 'esri',
+    "engine": 'engine',
+    "algorithm": 'algorithm',
+    "workers": 'workers',
+    "output": 'output',
+    "stream": 'stream',
+    "simplify": 'simplify',
+    "min_area": 'min_area',
+    "precision": 'precision',
+    "pyramid": 'pyramid'
 }
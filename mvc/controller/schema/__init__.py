@@ -1,8 +1,69 @@
 from mvc.controller.flaskapi import api
 from flask_restplus import fields
 from mvc.controller.schema.ogc import crs_properties
+from setting import VIEWSHED_MIN_DISTANCE, VIEWSHED_MAX_DISTANCE
+
+
+class Swath(fields.Raw):
+    # A number of degrees, or one of the swath modes, so the schema leaves the type open
+    __schema_type__ = None
+
 
 wps = api.model('wps', {
     'service': fields.String(required=True, readOnly=True, description="WPS name"),
     'projection': fields.String(required=True, readOnly=True, description="Use EPSG/OGC standard")
 })
+
+cache = api.model('cache', {
+    'hits': fields.Integer(readOnly=True, description='DEM tiles served from the cache by this worker'),
+    'misses': fields.Integer(readOnly=True, description='DEM tiles fetched from GeoServer by this worker'),
+    'evictions': fields.Integer(readOnly=True, description='DEM tiles evicted by this worker to stay under the size '
+                                                           'limit'),
+    'tiles': fields.Integer(readOnly=True, description='DEM tiles currently cached, shared by every worker'),
+    'size': fields.Integer(readOnly=True, description='Cache size on disk (bytes), shared by every worker'),
+    'size_limit': fields.Integer(readOnly=True, description='Cache size limit (bytes), for every worker together')
+})
+
+viewshed_batch = api.model('viewshed_batch', {
+    'coordinates': fields.List(fields.List(fields.Float), required=True,
+                               description='observers as [longitude, latitude] pairs'),
+    'distance': fields.Float(default=1000.0, description='view distance (meter), minimum to %s, maximum to %s' % (
+        VIEWSHED_MIN_DISTANCE, VIEWSHED_MAX_DISTANCE)),
+    'height': fields.Float(default=1.70, description='observer height from ground (meter)'),
+    'offset': fields.Float(default=0.0, description='target offset from ground (meter)'),
+    'swath': Swath(default=0.15, description='azimuth step range (angle in degree), auto or split'),
+    'curvature': fields.Boolean(default=False, description='considering earth curvature'),
+    'refraction': fields.Boolean(default=False, description='considering atmospheric refraction'),
+    'k': fields.Float(default=0.13, description='atmospheric refraction factor'),
+    'use_swath': fields.Boolean(default=True, description='if set to false, a full 360 degree scanning is used'),
+    'earth_radius': fields.Float(default=6371000.0, description='earth radius (meter)'),
+    'resolution': fields.Integer(default=30, description='DEM resolution, 10|30 meters'),
+    'esri': fields.Boolean(default=False, description="ESRI's method to calculate earth curvature"),
+    'engine': fields.String(default='numpy', enum=['numpy', 'loop', 'template'], description='line of sight engine'),
+    'algorithm': fields.String(default='ray', enum=['ray', 'sweep'], description='viewshed algorithm')
+})
+
+viewshed_cumulative = api.inherit('viewshed_cumulative', viewshed_batch, {
+    'output': fields.String(default='geojson', enum=['geojson', 'geotiff'],
+                            description='count polygons classed by number of observers (DN) or an Int32 GeoTIFF')
+})
+
+result_cache = api.model('result_cache', {
+    'hits': fields.Integer(readOnly=True, description='Results served from memory'),
+    'disk_hits': fields.Integer(readOnly=True, description='Results served from disk'),
+    'misses': fields.Integer(readOnly=True, description='Results computed'),
+    'results': fields.Integer(readOnly=True, description='Results in memory'),
+    'size': fields.Integer(readOnly=True, description='Serialized size of results in memory (bytes)'),
+    'size_limit': fields.Integer(readOnly=True, description='Memory size limit (bytes)'),
+    'disk_results': fields.Integer(readOnly=True, description='Results on disk'),
+    'disk_size': fields.Integer(readOnly=True, description='Size of results on disk (bytes)'),
+    'disk_limit': fields.Integer(readOnly=True, description='Disk size limit (bytes)')
+})
+
+job = api.model('job', {
+    'id': fields.String(readOnly=True, description='Job id'),
+    'status': fields.String(readOnly=True, enum=['queued', 'running', 'finished', 'failed'], description='Job status'),
+    'done': fields.Integer(readOnly=True, description='Steps done (rays, or rings for the sweep algorithm)'),
+    'total': fields.Integer(readOnly=True, description='Steps in total, 0 until the job starts computing'),
+    'message': fields.String(readOnly=True, description='Reason of failure')
+})
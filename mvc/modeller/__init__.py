@@ -1,16 +1,16 @@
-import os
 import json
-import uuid
-import shutil
+import math
 import logging
-import requests
-import tempfile
-from setting import GEOSERVER_URL
-from pyproj import Proj, transform
-from mvc.controller.schema.ogc.epsg import code
+from osgeo import gdal
+from setting import BATCH_WORKERS, DEM_PIXEL_SIZE
+from mvc.modeller.source import dem_source
+from mvc.modeller.metrics import metrics
 from mvc.modeller.properties import PROP_DEFAULT
 from mvc.controller.schema.ogc.epsg import WGS84
-from mvc.modeller.algorithm import viewshed_payload, raster_viewshed, get_aeqd
+from mvc.modeller.algorithm import raster_viewshed, batch_viewshed, cumulative_viewshed, \
+    viewshed_bbox, get_layer, array2geotiff, polygonize_array, snap_coords, raster_visibility, polygonize_layer, \
+    iter_features, get_vertex_summary, array2cog, pyramid_viewshed, pyramid_visibility, iter_pyramid_features, \
+    polygonize_levels, iter_timed_features
 
 log = logging.getLogger(__name__)
 
@@ -39,32 +39,173 @@ class ViewShed(object):
         self.earth_radius = None
         self.resolution = None
         self.esri = None
+        self.engine = None
+        self.algorithm = None
+        self.workers = None
+        self.simplify = None
+        self.min_area = None
+        self.precision = None
+        self.pyramid = None
         for prop, default in ViewShed.prop_defaults.items():
             setattr(self, prop, kwargs.get(prop, default))
 
+    def analysis(self, progress=None):
+        min_x, min_y, max_x, max_y = viewshed_bbox(self.x, self.y, self.distance)
+        dem = self.download(min_x, min_y, max_x, max_y)
+        if dem is not None:
+            try:
+                if self.pyramid:
+                    return pyramid_viewshed(observer=(self.x, self.y), observer_height=self.height,
+                                            target_offset=self.offset, radius=self.distance,
+                                            earth_curvature=self.curvature, refraction=self.refraction, k=self.k,
+                                            earth_radius=self.earth_radius, esri=self.esri, simplify=self.simplify,
+                                            min_area=self.min_area, precision=self.precision, geotiff=dem,
+                                            progress=progress)
+                return raster_viewshed(observer=(self.x, self.y), observer_height=self.height,
+                                       target_offset=self.offset, radius=self.distance, swath=self.swath,
+                                       earth_curvature=self.curvature, refraction=self.refraction, k=self.k,
+                                       use_swath=self.use_swath, earth_radius=self.earth_radius, esri=self.esri,
+                                       engine=self.engine, algorithm=self.algorithm, workers=self.workers,
+                                       simplify=self.simplify, min_area=self.min_area, precision=self.precision,
+                                       geotiff=dem, progress=progress)
+            finally:
+                dem_source.release(dem)
+
+    def stream(self, progress=None):
+        # Visibility and polygons are computed up front, so that failures surface before the response starts and
+        # both show in its Server-Timing header. Only the conversion of polygons to GeoJSON is streamed: the polygons
+        # wait in OGR memory layers and become features one at a time as the response is written. The vertex summary
+        # fills up as the features are consumed. The level summary of a pyramid viewshed is complete before the first
+        # feature, it is None otherwise.
+        min_x, min_y, max_x, max_y = viewshed_bbox(self.x, self.y, self.distance)
+        dem = self.download(min_x, min_y, max_x, max_y)
+        if dem is not None:
+            if self.pyramid:
+                try:
+                    levels = pyramid_visibility(observer=(self.x, self.y), observer_height=self.height,
+                                                target_offset=self.offset, radius=self.distance,
+                                                earth_curvature=self.curvature, refraction=self.refraction, k=self.k,
+                                                earth_radius=self.earth_radius, esri=self.esri, geotiff=dem,
+                                                progress=progress)
+                finally:
+                    dem_source.release(dem)
+                vertices = get_vertex_summary()
+                with metrics.timer('polygonize'):
+                    layers = polygonize_levels(levels)
+                features = iter_pyramid_features(layers, self.simplify, self.min_area, self.precision,
+                                                 self.earth_radius, vertices)
+                return iter_timed_features(features), vertices, [summary for geotransform, array, summary in levels]
+            try:
+                geotransform, array = raster_visibility(observer=(self.x, self.y), observer_height=self.height,
+                                                        target_offset=self.offset, radius=self.distance,
+                                                        swath=self.swath, earth_curvature=self.curvature,
+                                                        refraction=self.refraction, k=self.k,
+                                                        use_swath=self.use_swath, earth_radius=self.earth_radius,
+                                                        esri=self.esri, engine=self.engine, algorithm=self.algorithm,
+                                                        workers=self.workers, geotiff=dem, progress=progress)
+            finally:
+                dem_source.release(dem)
+            vertices = get_vertex_summary()
+            with metrics.timer('polygonize'):
+                source = polygonize_layer(array, geotransform)
+            features = iter_features(source, self.simplify, self.min_area, self.precision, self.earth_radius,
+                                     vertices)
+            return iter_timed_features(features), vertices, None
+
+    def raster(self, progress=None):
+        # The uint8 visibility array as a cloud optimized GeoTIFF, polygonization is skipped entirely
+        min_x, min_y, max_x, max_y = viewshed_bbox(self.x, self.y, self.distance)
+        dem = self.download(min_x, min_y, max_x, max_y)
+        if dem is not None:
+            try:
+                geotransform, array = raster_visibility(observer=(self.x, self.y), observer_height=self.height,
+                                                        target_offset=self.offset, radius=self.distance,
+                                                        swath=self.swath, earth_curvature=self.curvature,
+                                                        refraction=self.refraction, k=self.k,
+                                                        use_swath=self.use_swath, earth_radius=self.earth_radius,
+                                                        esri=self.esri, engine=self.engine, algorithm=self.algorithm,
+                                                        workers=self.workers, geotiff=dem, progress=progress)
+            finally:
+                dem_source.release(dem)
+            with metrics.timer('encode'):
+                return array2cog(geotransform, array)
+
+    def is_local(self):
+        # A pyramid viewshed reads its whole bbox at full resolution, it is only affordable when nothing is downloaded
+        min_x, min_y, max_x, max_y = viewshed_bbox(self.x, self.y, self.distance)
+        return dem_source.is_local(get_layer(self.resolution), min_x, min_y, max_x, max_y)
+
+    def snap(self):
+        self.x, self.y = snap_coords(self.x, self.y, DEM_PIXEL_SIZE[get_layer(self.resolution)])
+
+    def cache_key(self):
+        # workers and the exact engines do not change the result, so they are left out of the key
+        key = {"x": self.x, "y": self.y, "template": self.engine == 'template'}
+        for prop in ViewShed.prop_defaults:
+            if prop not in ('engine', 'workers'):
+                value = getattr(self, prop)
+                if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                    value = float(value)
+                key[prop] = value
+        return key
+
+    def download(self, min_x, min_y, max_x, max_y):
+        # Returns the DEM covering the bbox as read_image accepts it, to be handed back to dem_source.release
+        with metrics.timer('download'):
+            return dem_source.open(get_layer(self.resolution), min_x, min_y, max_x, max_y)
+
+
+class BatchViewShed(ViewShed):
+    def __init__(self, observers, **kwargs):
+        super(BatchViewShed, self).__init__(None, None, **kwargs)
+        self.observers = observers
+
+    def analysis(self):
+        min_x, min_y, max_x, max_y = self.union_bbox()
+        dem = self.download(min_x, min_y, max_x, max_y)
+        if dem is not None:
+            try:
+                return batch_viewshed(observers=self.observers, observer_height=self.height,
+                                      target_offset=self.offset, radius=self.distance, swath=self.swath,
+                                      earth_curvature=self.curvature, refraction=self.refraction, k=self.k,
+                                      use_swath=self.use_swath, earth_radius=self.earth_radius, esri=self.esri,
+                                      engine=self.engine, algorithm=self.algorithm, bbox=(min_x, min_y, max_x, max_y),
+                                      geotiff=dem, workers=BATCH_WORKERS)
+            finally:
+                dem_source.release(dem)
+
+    def union_bbox(self):
+        bboxes = [viewshed_bbox(x, y, self.distance) for x, y in self.observers]
+        return min(bbox[0] for bbox in bboxes), min(bbox[1] for bbox in bboxes), \
+            max(bbox[2] for bbox in bboxes), max(bbox[3] for bbox in bboxes)
+
+    def union_pixels(self):
+        # DEM pixels read for the whole batch, observers far apart read everything between them
+        min_x, min_y, max_x, max_y = self.union_bbox()
+        pixel_size = DEM_PIXEL_SIZE[get_layer(self.resolution)]
+        return int(math.ceil((max_x - min_x) / pixel_size)) * int(math.ceil((max_y - min_y) / pixel_size))
+
+
+class CumulativeViewShed(BatchViewShed):
+    def __init__(self, observers, output='geojson', **kwargs):
+        super(CumulativeViewShed, self).__init__(observers, **kwargs)
+        self.output = output
+
     def analysis(self):
-        p1 = Proj(init='epsg:' + code[1])
-        p2 = get_aeqd(self.x, self.y)
-        buffer_distance = self.distance * 1.1
-        min_x, min_y = transform(p2, p1, x=0.0 - buffer_distance, y=0.0 - buffer_distance)
-        max_x, max_y = transform(p2, p1, x=0.0 + buffer_distance, y=0.0 + buffer_distance)
-        querystring = viewshed_payload(min_x, min_y, max_x, max_y, self.resolution)
-        response = requests.get(url=GEOSERVER_URL, stream=True, params=querystring)
-        if response.status_code is 200:
-            tmpdir = tempfile.gettempdir()
-            basename = str(uuid.uuid4())
-            rasterfile = os.path.join(tmpdir, basename)
-            with open(rasterfile, 'wb') as f:
-                response.raw.decode_content = True
-                shutil.copyfileobj(response.raw, f)
-            vectorfile = raster_viewshed(observer=(self.x, self.y), observer_height=self.height,
-                                         target_offset=self.offset, radius=self.distance, swath=self.swath,
-                                         earth_curvature=self.curvature, refraction=self.refraction, k=self.k,
-                                         use_swath=self.use_swath, earth_radius=self.earth_radius, esri=self.esri,
-                                         geotiff=rasterfile, tmpdir=tmpdir, basename=basename)
-            with open(vectorfile, 'r') as data:
-                result = json.loads(data.read())
-            data.close()
-            os.remove(rasterfile)
-            os.remove(vectorfile)
-            return result
+        min_x, min_y, max_x, max_y = self.union_bbox()
+        dem = self.download(min_x, min_y, max_x, max_y)
+        if dem is not None:
+            try:
+                geotransform, array = cumulative_viewshed(observers=self.observers, observer_height=self.height,
+                                                          target_offset=self.offset, radius=self.distance,
+                                                          swath=self.swath, earth_curvature=self.curvature,
+                                                          refraction=self.refraction, k=self.k,
+                                                          use_swath=self.use_swath, earth_radius=self.earth_radius,
+                                                          esri=self.esri, engine=self.engine,
+                                                          algorithm=self.algorithm, bbox=(min_x, min_y, max_x, max_y),
+                                                          geotiff=dem, workers=BATCH_WORKERS)
+            finally:
+                dem_source.release(dem)
+            if self.output == 'geotiff':
+                return array2geotiff(geotransform, array, gdal.GDT_Int32)
+            return polygonize_array(array, geotransform, gdal.GDT_Int32)
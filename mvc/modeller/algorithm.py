@@ -1,101 +1,676 @@
 import os
-import sys
 import math
+import json
+import zlib
 import time
+import uuid
 import logging
-import subprocess
+import threading
+import multiprocessing
 import numpy as np
 from osgeo import osr
+from osgeo import ogr
 from osgeo import gdal
 from datetime import datetime
+from collections import OrderedDict
 from bresenham import bresenham
 from pyproj import Proj, transform
+from mvc.controller.schema.ogc.crs import CRS84
 from mvc.controller.schema.ogc.epsg import code
-from setting import WCS_VERSION, DEM_10METERS, DEM_30METERS
+from mvc.modeller.metrics import metrics
+from mvc.modeller.properties import SWATH_MODES
+from setting import WCS_VERSION, DEM_10METERS, DEM_30METERS, RASTER_BLOCK_SIZE, PYRAMID_BASE_DISTANCE, \
+    BATCH_SHARED_DIR
 
 log = logging.getLogger(__name__)
 
+SWEEP_HORIZON_FLOOR = np.finfo(np.float64).min / 4
+VECTORIZED_CHUNK = 512  # rays packed together by the numpy engine
+AEQD_CACHE_SIZE = 128  # observer projections kept
+RAY_TEMPLATE_CACHE_SIZE = 16  # ray templates kept, a 5 km / 10 m template is about 7 MB
+RAY_TEMPLATE_BAND = 0.1  # degrees of latitude sharing one ray template
+RAY_TEMPLATE_TOLERANCE = 1.0  # pixels of endpoint drift allowed on top of sub-pixel viewpoint rounding
+SWATH_SPLIT_RING = 64  # pixels, rays of the split swath cover this ring first and double every time distance doubles
+WINDOW_MARGIN = 2  # pixels around the view distance, reprojected and translated ray ends may land past it
+CORRECTION_CACHE_SIZE = 4  # window geometries whose correction surfaces are kept, about 13 MB a surface at 5 km / 10 m
+SLOPE_BUFFER_POOL_SIZE = 4  # window sized float64 buffers kept for reuse, observers of a batch share one size
+
+batch_pool = None
+sector_slopes = None
+wgs84 = None
+wgs84_srs = None
+drivers = dict()
+aeqd_cache = OrderedDict()
+aeqd_lock = threading.Lock()
+ray_templates = OrderedDict()
+ray_template_lock = threading.Lock()
+corrections = OrderedDict()
+correction_lock = threading.Lock()
+slope_buffers = OrderedDict()
+slope_buffer_lock = threading.Lock()
+
 
 def raster_viewshed(observer, observer_height, target_offset, radius, swath, earth_curvature, refraction, k, use_swath,
-                    earth_radius, esri, geotiff, tmpdir, basename):
+                    earth_radius, esri, engine, algorithm, workers, simplify, min_area, precision, geotiff,
+                    progress=None):
     start_time = time.time()
     log.info('Started at: %s' % str(datetime.now()))
+    with metrics.timer('read'):
+        geotransform, matrix = read_image(geotiff, viewshed_bbox(observer[0], observer[1], radius))
+    metrics.increment('viewshed_dem_pixels_total', matrix.size)
     viewshed_vector = generating_viewshed(observer, observer_height, target_offset, radius, swath, earth_curvature,
-                                          refraction, k, use_swath, earth_radius, esri, geotiff, tmpdir, basename)
+                                          refraction, k, use_swath, earth_radius, esri, engine, algorithm, workers,
+                                          geotransform, matrix, simplify=simplify, min_area=min_area,
+                                          precision=precision, progress=progress)
     log.info("Finished at: %ss" % round((time.time() - start_time), 3))
     return viewshed_vector
 
 
+def raster_visibility(observer, observer_height, target_offset, radius, swath, earth_curvature, refraction, k,
+                      use_swath, earth_radius, esri, engine, algorithm, workers, geotiff, progress=None):
+    start_time = time.time()
+    log.info('Started at: %s' % str(datetime.now()))
+    with metrics.timer('read'):
+        geotransform, matrix = read_image(geotiff, viewshed_bbox(observer[0], observer[1], radius))
+    metrics.increment('viewshed_dem_pixels_total', matrix.size)
+    array = calculate_visibility(observer, observer_height, target_offset, radius, swath, earth_curvature, refraction,
+                                 k, use_swath, earth_radius, esri, engine, algorithm, workers, geotransform, matrix,
+                                 progress)
+    log.info('OBSERVER: Viewpoint=(%s,%s), height=%sm' % (observer[0], observer[1], observer_height))
+    log.info("Finished visibility at: %ss" % round((time.time() - start_time), 3))
+    return geotransform, array
+
+
+def pyramid_viewshed(observer, observer_height, target_offset, radius, earth_curvature, refraction, k, earth_radius,
+                     esri, simplify, min_area, precision, geotiff, progress=None):
+    start_time = time.time()
+    log.info('Started at: %s' % str(datetime.now()))
+    levels = pyramid_visibility(observer, observer_height, target_offset, radius, earth_curvature, refraction, k,
+                                earth_radius, esri, geotiff, progress)
+    vertices = get_vertex_summary()
+    with metrics.timer('polygonize'):
+        features = list(iter_pyramid_features(polygonize_levels(levels), simplify, min_area, precision, earth_radius,
+                                              vertices))
+    metrics.increment('viewshed_polygons_total', len(features))
+    log.info("Finished at: %ss" % round((time.time() - start_time), 3))
+    return get_feature_collection(features, vertices, [summary for geotransform, array, summary in levels])
+
+
+def pyramid_visibility(observer, observer_height, target_offset, radius, earth_curvature, refraction, k,
+                       earth_radius, esri, geotiff, progress=None):
+    # Multi-resolution visibility for view distances past a full resolution window. Returns (geotransform, array,
+    # summary) per level, the array of a level only marks cells of its own ring. Every level casts the same rays,
+    # the auto swath of the full resolution level, which also suits the outer ring of the others since their cell
+    # size grows with their distance. A ray starts a level with the horizon it reached at the end of the one before.
+    start_time = time.time()
+    distances = get_pyramid_distances(radius)
+    levels = list()
+    horizons = None
+
+    def level_progress(count, total):
+        # Every level casts the same number of rays
+        progress(level * total + count, total * len(distances))
+
+    for level, distance in enumerate(distances):
+        started = time.time()
+        with metrics.timer('read'):
+            if level == 0:
+                geotransform, matrix = read_image(geotiff, viewshed_bbox(observer[0], observer[1], distance))
+                base = matrix
+                bias = 0.0
+            else:
+                geotransform, matrix = read_pyramid_level(geotiff, observer, distance, pixel_size, 2 ** level)
+                bias = get_relief_bias(base, 2 ** level)
+        metrics.increment('viewshed_dem_pixels_total', matrix.size)
+        read = time.time() - started
+        pxw = (math.pi * abs(geotransform[1]) * earth_radius) / 180.0
+        pxh = (math.pi * abs(geotransform[5]) * earth_radius) / 180.0
+        if level == 0:
+            pixel_size = (geotransform[1], geotransform[5])
+            viewpoint = transform_coords(geotransform, observer[0], observer[1])
+            ha = get_bilinear_height(geotransform, viewpoint, matrix, observer) + observer_height
+            azimuths = get_azimuths(get_auto_swath(geotransform, observer, distance, earth_radius))
+        started = time.time()
+        with metrics.timer('visibility'):
+            window_geotransform, window, horizons = calculate_pyramid_level(
+                geotransform, matrix, observer, ha, distances[level - 1] if level else 0.0, distance, azimuths,
+                horizons, observer_height, target_offset, earth_curvature, refraction, k, earth_radius, esri,
+                None if progress is None else level_progress)
+        # Slopes are per pixel of distance, the next level has half as many pixels to the same cell
+        horizons = horizons * 2.0
+        visible = int(np.count_nonzero(window))
+        metrics.increment('viewshed_rays_total', len(azimuths))
+        metrics.increment('viewshed_visible_pixels_total', visible)
+        levels.append((window_geotransform, window, {
+            "level": level,
+            "distance": [distances[level - 1] if level else 0.0, distance],
+            "cell_size": round(min(pxw * math.cos(math.radians(observer[1])), pxh), 1),
+            "relief_bias": round(bias, 2),
+            "rays": len(azimuths),
+            "visible": visible,
+            "seconds": {"read": round(read, 4), "visibility": round(time.time() - started, 4)}
+        }))
+        log.info('PYRAMID LEVEL %s: %s' % (level, levels[-1][2]))
+    log.info('OBSERVER: Viewpoint=(%s,%s), height=%sm' % (observer[0], observer[1], observer_height))
+    log.info("Finished pyramid visibility at: %ss" % round((time.time() - start_time), 3))
+    return levels
+
+
+def batch_viewshed(observers, observer_height, target_offset, radius, swath, earth_curvature, refraction, k, use_swath,
+                   earth_radius, esri, engine, algorithm, bbox, geotiff, workers):
+    start_time = time.time()
+    log.info('Started batch of %s observers at: %s' % (len(observers), str(datetime.now())))
+    geotransform, matrix = read_image(geotiff, bbox)
+    params = (observer_height, target_offset, radius, swath, earth_curvature, refraction, k, use_swath, earth_radius,
+              esri, engine, algorithm, 1)
+    if workers == 1 or not can_fork():
+        features = [get_batch_feature(i, observer, params, geotransform, matrix)
+                    for i, observer in enumerate(observers)]
+    else:
+        path = share_dem(matrix)
+        try:
+            features = get_batch_pool(workers).map(batch_worker, [(i, observer, params, geotransform, path)
+                                                                  for i, observer in enumerate(observers)])
+        finally:
+            os.remove(path)
+    log.info("Finished batch at: %ss" % round((time.time() - start_time), 3))
+    return {
+        "type": "FeatureCollection",
+        "crs": {"type": "name", "properties": {"name": CRS84}},
+        "features": features
+    }
+
+
+def get_batch_pool(workers):
+    # One pool of workers processes per process, created on first use and shared by every batch and cumulative
+    # viewshed after it, so that concurrent requests never fork more than workers processes. Only used from the main
+    # thread, see can_fork.
+    global batch_pool
+    if batch_pool is None:
+        batch_pool = fork_pool(workers, None, ())
+    return batch_pool
+
+
+def share_dem(matrix):
+    # The DEM of a batch goes to the pool as a .npy file in BATCH_SHARED_DIR that every worker maps read only, rather
+    # than pickled once per task. The caller removes it once the batch is done.
+    path = os.path.join(BATCH_SHARED_DIR, 'viewshed-batch-%s.npy' % uuid.uuid4())
+    np.save(path, matrix)
+    return path
+
+
+def batch_worker(task):
+    i, observer, params, geotransform, path = task
+    return get_batch_feature(i, observer, params, geotransform, np.load(path, mmap_mode='r'))
+
+
+def get_batch_feature(i, observer, params, geotransform, matrix):
+    viewshed_vector = generating_viewshed(observer, *(params + (geotransform, matrix)))
+    return {
+        "type": "Feature",
+        "properties": {"id": i, "observer": list(observer)},
+        "geometry": {
+            "type": "MultiPolygon",
+            "coordinates": [feature['geometry']['coordinates'] for feature in viewshed_vector['features']]
+        }
+    }
+
+
+def cumulative_viewshed(observers, observer_height, target_offset, radius, swath, earth_curvature, refraction, k,
+                        use_swath, earth_radius, esri, engine, algorithm, bbox, geotiff, workers):
+    start_time = time.time()
+    log.info('Started cumulative viewshed of %s observers at: %s' % (len(observers), str(datetime.now())))
+    geotransform, matrix = read_image(geotiff, bbox)
+    params = (observer_height, target_offset, radius, swath, earth_curvature, refraction, k, use_swath, earth_radius,
+              esri, engine, algorithm, 1)
+    array = np.zeros(matrix.shape, dtype=np.int32)
+    if workers == 1 or not can_fork():
+        for observer in observers:
+            array[calculate_visibility(observer, *(params + (geotransform, matrix))) > 0] += 1
+    else:
+        # Workers send back the indices of the cells they found visible, counted here as they arrive, so at most one
+        # mask per worker is alive at any time
+        counts = array.reshape(-1)
+        path = share_dem(matrix)
+        try:
+            for visible in get_batch_pool(workers).imap_unordered(cumulative_worker, [(observer, params, geotransform,
+                                                                                       path) for observer in observers]):
+                counts[visible] += 1
+        finally:
+            os.remove(path)
+    log.info("Finished cumulative viewshed at: %ss" % round((time.time() - start_time), 3))
+    return geotransform, array
+
+
+def cumulative_worker(task):
+    observer, params, geotransform, path = task
+    array = calculate_visibility(observer, *(params + (geotransform, np.load(path, mmap_mode='r'))))
+    return np.flatnonzero(array).astype(np.int32)
+
+
 def generating_viewshed(observer, observer_height, target_offset, radius, swath, earth_curvature, refraction, k,
-                        use_swath, earth_radius, esri, geotiff, tmpdir, basename):
-    viewshed_raster = os.path.join(tmpdir, basename + 'vs')
-    viewshed_vector = os.path.join(tmpdir, basename + 'jn')
-    geotransform, matrix = read_image(geotiff)
+                        use_swath, earth_radius, esri, engine, algorithm, workers, geotransform, matrix,
+                        simplify=0.0, min_area=0.0, precision=None, progress=None):
+    array = calculate_visibility(observer, observer_height, target_offset, radius, swath, earth_curvature, refraction,
+                                 k, use_swath, earth_radius, esri, engine, algorithm, workers, geotransform, matrix,
+                                 progress)
+    with metrics.timer('polygonize'):
+        viewshed_vector = polygonize_array(array, geotransform, simplify=simplify, min_area=min_area,
+                                           precision=precision, earth_radius=earth_radius)
+    metrics.increment('viewshed_polygons_total', len(viewshed_vector['features']))
+    log.info('OBSERVER: Viewpoint=(%s,%s), height=%sm' % (observer[0], observer[1], observer_height))
+    log.info('VIEWSHED: %s polygons, %s of %s vertices kept' % (len(viewshed_vector['features']),
+                                                                  viewshed_vector['vertices']['simplified'],
+                                                                  viewshed_vector['vertices']['original']))
+    return viewshed_vector
+
+
+def calculate_visibility(observer, observer_height, target_offset, radius, swath, earth_curvature, refraction, k,
+                         use_swath, earth_radius, esri, engine, algorithm, workers, geotransform, matrix,
+                         progress=None):
+    # progress, when given, is called with (done, total) steps: rays for the ray algorithm, rings for the sweep
     viewpoint = transform_coords(geotransform, observer[0], observer[1])
-    viewlines = calculate_viewlines(geotransform, observer, radius, use_swath, swath, viewpoint)
+    if algorithm == 'sweep':
+        with metrics.timer('visibility'):
+            array = calculate_viewshed_sweep(viewpoint, matrix, geotransform, earth_radius, observer,
+                                             observer_height, radius, earth_curvature, target_offset, refraction, k,
+                                             esri, progress)
+        metrics.increment('viewshed_visible_pixels_total', int(np.count_nonzero(array)))
+        return array
+    # Rays run on the slopes of a window around the viewpoint, in window coordinates, and their mask is put back
+    pxw = (math.pi * abs(geotransform[1]) * earth_radius) / 180.0
+    pxh = (math.pi * abs(geotransform[5]) * earth_radius) / 180.0
+    ha = get_bilinear_height(geotransform, viewpoint, matrix, observer) + observer_height
+    rings = int(math.ceil(radius / min(pxw * math.cos(math.radians(observer[1])), pxh))) + WINDOW_MARGIN
+    # The loop engine is the reference the others are compared with, it corrects heights pixel by pixel itself
+    loop = engine == 'loop' and not (use_swath and swath == 'split')
+    with metrics.timer('slopes'):
+        if loop:
+            surface = get_height_window(matrix, viewpoint, rings)
+        else:
+            surface = get_slope_window(matrix, viewpoint, rings, ha, pxw, pxh, earth_curvature, observer_height,
+                                       earth_radius, target_offset, refraction, k, esri)
+    center = (rings, rings)
+    window_geotransform = get_window_geotransform(geotransform, viewpoint, rings)
+    try:
+        if use_swath and swath == 'split':
+            with metrics.timer('visibility'):
+                window, rays = calculate_viewshed_split(window_geotransform, observer, radius, center, surface,
+                                                        earth_radius, progress)
+            metrics.increment('viewshed_rays_total', rays)
+        else:
+            template = None
+            if engine == 'template':
+                with metrics.timer('rays'):
+                    template = get_ray_template(geotransform, observer, radius, use_swath, swath, earth_radius)
+            if template is not None:
+                metrics.increment('viewshed_rays_total', len(template.lengths))
+                with metrics.timer('visibility'):
+                    window = calculate_viewshed_template(template, center, surface, progress)
+            else:
+                with metrics.timer('rays'):
+                    viewlines = calculate_viewlines(window_geotransform, observer, radius, use_swath, swath, center,
+                                                    earth_radius)
+                metrics.increment('viewshed_rays_total', len(viewlines))
+                with metrics.timer('visibility'):
+                    if loop:
+                        window = calculate_viewshed(extract_masks(viewlines, center), center, surface,
+                                                    get_mask(surface.shape), ha, pxw, pxh, target_offset,
+                                                    earth_curvature, observer_height, earth_radius, refraction, k,
+                                                    esri, progress)
+                    elif workers > 1 and can_fork():
+                        window = calculate_viewshed_parallel(viewlines, center, surface, workers, progress)
+                    else:
+                        window = calculate_sectors(viewlines, center, surface, progress)
+    finally:
+        release_slope_buffer(surface)
+    array = put_window(get_mask(matrix.shape), viewpoint, rings, window)
+    metrics.increment('viewshed_visible_pixels_total', int(np.count_nonzero(array)))
+    return array
+
+
+def calculate_sectors(viewlines, viewpoint, surface, progress=None):
     sectors = extract_masks(viewlines, viewpoint)
-    sectors = calculate_viewshed(sectors, viewpoint, matrix, geotransform, earth_radius, observer, observer_height,
-                                 earth_curvature, target_offset, refraction, k, esri)
-    mask = aggregate_masks(sectors)
-    array = generate_mask(mask, get_zeros(matrix.shape))
-    array2raster(viewshed_raster, (geotransform[0], geotransform[3]), geotransform[1], geotransform[5], array)
-    polygonize_raster(viewshed_raster, viewshed_vector, observer, observer_height)
-    os.remove(viewshed_raster)
-    return viewshed_vector
+    return calculate_viewshed_vectorized(sectors, viewpoint, surface, get_mask(surface.shape), progress)
 
 
-def polygonize_raster(viewshed_raster, viewshed_vector, observer, observer_height):
-    cmd = ['gdal_polygonize.py', '-mask', viewshed_raster, viewshed_raster, '-f', 'GEOJSON', viewshed_vector]
-    p = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = p.communicate()
-    if p.returncode != 0:
-        log.info(sys.stderr, 'ERROR: %s' % err)
-        sys.exit(-1)
-    log.info('OBSERVER: Viewpoint=(%s,%s), height=%sm' % (observer[0], observer[1], observer_height))
-    log.info('VIEWSHED: %s' % viewshed_vector)
+def calculate_viewshed_parallel(viewlines, viewpoint, surface, workers, progress=None):
+    # Rays are split into contiguous chunks, one per worker. The slopes are handed to the forked workers once through
+    # the pool initializer, so only ray endpoints and visible pixel indices cross process boundaries. The merged mask
+    # is a union of the partial masks, so it does not depend on scheduling.
+    chunk = int(math.ceil(len(viewlines) / float(workers)))
+    tasks = [(viewlines[i:i + chunk], viewpoint) for i in range(0, len(viewlines), chunk)]
+    pool = fork_pool(workers, init_sector_worker, (surface,))
+    array = get_mask(surface.shape)
+    try:
+        for i, (ys, xs) in enumerate(pool.imap(sector_worker, tasks)):
+            array[ys, xs] = 1
+            if progress is not None:
+                progress(min((i + 1) * chunk, len(viewlines)), len(viewlines))
+    finally:
+        pool.close()
+        pool.join()
+    return array
 
 
-def array2raster(new_raster_fn, raster_origin, pixel_width, pixel_height, array):
+def can_fork():
+    # Pools are only forked from the main thread of a process that is not a pool worker itself. Job threads and
+    # threaded servers run the same work in their own thread instead.
+    return isinstance(threading.current_thread(), threading._MainThread) and \
+        not multiprocessing.current_process().daemon
+
+
+def fork_pool(workers, initializer, initargs):
+    # The locks other threads take are held while the workers are forked, so that no child starts with a copy of a
+    # lock acquired by a thread it does not have. Every child releases its own copies before its initializer.
+    locks = get_fork_locks()
+    for lock in locks:
+        lock.acquire()
+    try:
+        return multiprocessing.Pool(processes=workers, initializer=init_forked_worker,
+                                    initargs=(initializer, initargs))
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+
+def get_fork_locks():
+    # In a fixed order: the logging module lock, the logging handlers, then the locks of this module
+    handlers = [handler for handler in (ref() for ref in logging._handlerList) if handler is not None]
+    locks = [logging._lock] + [handler.lock for handler in handlers] + \
+        [metrics.lock, aeqd_lock, ray_template_lock, correction_lock, slope_buffer_lock]
+    return [lock for lock in locks if lock is not None]
+
+
+def init_forked_worker(initializer, initargs):
+    for lock in reversed(get_fork_locks()):
+        try:
+            lock.release()
+        except (threading.ThreadError, RuntimeError):
+            # Not held, the worker was forked again by the pool after one of them exited
+            pass
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def init_sector_worker(surface):
+    global sector_slopes
+    sector_slopes = surface
+
+
+def sector_worker(task):
+    viewlines, viewpoint = task
+    mask = calculate_sectors(viewlines, viewpoint, sector_slopes)
+    ys, xs = np.nonzero(mask)
+    return ys.astype(np.int32), xs.astype(np.int32)
+
+
+def polygonize_array(array, geotransform, data_type=gdal.GDT_Byte, simplify=0.0, min_area=0.0, precision=None,
+                     earth_radius=6371000.0):
+    vertices = get_vertex_summary()
+    features = list(iter_features(polygonize_layer(array, geotransform, data_type), simplify, min_area, precision,
+                                  earth_radius, vertices))
+    return get_feature_collection(features, vertices)
+
+
+def get_feature_collection(features, vertices, levels=None):
+    collection = {
+        "type": "FeatureCollection",
+        "crs": {"type": "name", "properties": {"name": CRS84}},
+        "features": features,
+        "vertices": vertices
+    }
+    if levels is not None:
+        collection['levels'] = levels
+    return collection
+
+
+def polygonize_layer(array, geotransform, data_type=gdal.GDT_Byte):
+    # Polygons stay in an OGR memory layer, they only become Python objects when iter_features reaches them
+    srs = get_srs()
+    raster = get_driver('MEM').Create('', array.shape[1], array.shape[0], 1, data_type)
+    raster.SetGeoTransform(geotransform)
+    raster.SetProjection(srs.ExportToWkt())
+    band = raster.GetRasterBand(1)
+    band.WriteArray(array)
+    source = get_driver('Memory').CreateDataSource('')
+    layer = source.CreateLayer('viewshed', srs=srs, geom_type=ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('DN', ogr.OFTInteger))
+    gdal.Polygonize(band, band, layer, 0, [], callback=None)
+    return source
+
+
+def iter_features(source, simplify=0.0, min_area=0.0, precision=None, earth_radius=6371000.0, vertices=None):
+    # simplify (meter) and min_area (square meter) are converted to degrees at the mid latitude of the layer, which
+    # spans a few kilometers at most. Polygons are simplified with their longitudes scaled by the cosine of that
+    # latitude, where a degree is as long east-west as north-south, so that the tolerance holds along both axes.
+    # vertices, when given, is updated as features are produced.
+    layer = source.GetLayer(0)
+    min_x, max_x, min_y, max_y = layer.GetExtent() if layer.GetFeatureCount() else (0.0, 0.0, 0.0, 0.0)
+    meter = math.pi * earth_radius / 180.0
+    scale = math.cos(math.radians((min_y + max_y) / 2.0))
+    degree_area = pow(meter, 2) * scale
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        count = get_vertex_count(geometry)
+        if vertices is not None:
+            vertices['polygons'] += 1
+            vertices['original'] += count
+        if min_area > 0 and geometry.GetArea() * degree_area < min_area:
+            if vertices is not None:
+                vertices['dropped'] += 1
+            continue
+        if simplify > 0:
+            scale_longitudes(geometry, scale)
+            simplified = geometry.SimplifyPreserveTopology(simplify / meter)
+            scale_longitudes(simplified, 1.0 / scale)
+            feature.SetGeometry(simplified)
+            count = get_vertex_count(feature.GetGeometryRef())
+        if vertices is not None:
+            vertices['simplified'] += count
+        geojson = feature.ExportToJson(as_object=True)
+        geojson.pop('id', None)
+        if precision is not None:
+            geojson['geometry']['coordinates'] = round_coordinates(geojson['geometry']['coordinates'], precision)
+        yield geojson
+
+
+def polygonize_levels(levels):
+    # (source, summary) of every pyramid level, as iter_pyramid_features takes them
+    return [(polygonize_layer(array, geotransform), summary) for geotransform, array, summary in levels]
+
+
+def iter_pyramid_features(layers, simplify=0.0, min_area=0.0, precision=None, earth_radius=6371000.0,
+                          vertices=None):
+    # Features of every pyramid level in turn, each tagged with the level it comes from
+    for source, summary in layers:
+        for feature in iter_features(source, simplify, min_area, precision, earth_radius, vertices):
+            feature['properties']['level'] = summary['level']
+            yield feature
+
+
+def iter_timed_features(features):
+    # Streamed features are converted while the response is written, after the request and its Server-Timing header
+    # are done. Their conversion time goes to the stream stage and their count to the polygons, once the last
+    # feature went through or the client left.
+    count = 0
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.time()
+            try:
+                feature = next(features)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.time() - start
+            count += 1
+            yield feature
+    finally:
+        metrics.observe('viewshed_stage_seconds', elapsed, stage='stream')
+        metrics.increment('viewshed_polygons_total', count)
+
+
+def get_vertex_summary():
+    return {"polygons": 0, "dropped": 0, "original": 0, "simplified": 0}
+
+
+def get_vertex_count(geometry):
+    if geometry.GetGeometryCount() == 0:
+        return geometry.GetPointCount()
+    return sum(get_vertex_count(geometry.GetGeometryRef(i)) for i in range(geometry.GetGeometryCount()))
+
+
+def scale_longitudes(geometry, scale):
+    # In place, for every point of the geometry and of its parts
+    for i in range(geometry.GetPointCount()):
+        geometry.SetPoint_2D(i, geometry.GetX(i) * scale, geometry.GetY(i))
+    for i in range(geometry.GetGeometryCount()):
+        scale_longitudes(geometry.GetGeometryRef(i), scale)
+
+
+def round_coordinates(coordinates, precision):
+    if len(coordinates) and isinstance(coordinates[0], (list, tuple)):
+        return [round_coordinates(c, precision) for c in coordinates]
+    return [round(c, precision) for c in coordinates]
+
+
+def stream_feature_collection(features, vertices=None, levels=None):
+    # Same document as polygonize_array, written one feature at a time. The vertex summary is only complete once
+    # every feature went through, so it is written after them, as are the pyramid levels when given.
+    yield '{"type": "FeatureCollection", "crs": %s, "features": [' % json.dumps(
+        {"type": "name", "properties": {"name": CRS84}})
+    separator = ''
+    for feature in features:
+        yield separator + json.dumps(feature, separators=(',', ':'))
+        separator = ','
+    yield ']'
+    if vertices is not None:
+        yield ', "vertices": %s' % json.dumps(vertices)
+    if levels is not None:
+        yield ', "levels": %s' % json.dumps(levels)
+    yield '}'
+
+
+def stream_feature_sequence(features):
+    # GeoJSON text sequence (RFC 8142), every feature is a record of its own prefixed by a record separator
+    for feature in features:
+        yield '\x1e' + json.dumps(feature, separators=(',', ':')) + '\n'
+
+
+def stream_gzip(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def array2raster(new_raster_fn, raster_origin, pixel_width, pixel_height, array, data_type=gdal.GDT_Byte):
     if os.path.exists(new_raster_fn):
         os.remove(new_raster_fn)
     cols = array.shape[1]
     rows = array.shape[0]
     origin_x = raster_origin[0]
     origin_y = raster_origin[1]
-    driver = gdal.GetDriverByName('GTiff')
-    out_raster = driver.Create(new_raster_fn, cols, rows, 1, gdal.GDT_Byte)
+    driver = get_driver('GTiff')
+    out_raster = driver.Create(new_raster_fn, cols, rows, 1, data_type)
     out_raster.SetGeoTransform((origin_x, pixel_width, 0, origin_y, 0, pixel_height))
     outband = out_raster.GetRasterBand(1)
     outband.WriteArray(array)
-    out_raster_srs = osr.SpatialReference()
-    out_raster_srs.ImportFromEPSG(int(code[1]))
-    out_raster.SetProjection(out_raster_srs.ExportToWkt())
+    out_raster.SetProjection(get_srs().ExportToWkt())
     outband.FlushCache()
 
 
-def generate_mask(indices, zeros):
-    for i in indices:
-        zeros[i[1]][i[0]] = 1.0
-    return zeros
+def array2geotiff(geotransform, array, data_type=gdal.GDT_Byte):
+    geotiff = '/vsimem/' + str(uuid.uuid4()) + '.tif'
+    array2raster(geotiff, (geotransform[0], geotransform[3]), geotransform[1], geotransform[5], array, data_type)
+    data = read_vsimem(geotiff)
+    gdal.Unlink(geotiff)
+    return data
+
+
+def array2cog(geotransform, array, data_type=gdal.GDT_Byte):
+    # GDAL 2.2 has no COG driver. Overviews are built on an in-memory copy first, then copied along with it into a
+    # tiled GeoTIFF, which puts the overviews ahead of the full resolution tiles the way cloud optimized readers expect.
+    srs = get_srs()
+    raster = get_driver('MEM').Create('', array.shape[1], array.shape[0], 1, data_type)
+    raster.SetGeoTransform(geotransform)
+    raster.SetProjection(srs.ExportToWkt())
+    raster.GetRasterBand(1).WriteArray(array)
+    levels = get_overview_levels(array.shape, RASTER_BLOCK_SIZE)
+    if levels:
+        raster.BuildOverviews('NEAREST', levels)
+    geotiff = '/vsimem/' + str(uuid.uuid4()) + '.tif'
+    out_raster = get_driver('GTiff').CreateCopy(geotiff, raster, options=[
+        'TILED=YES', 'BLOCKXSIZE=%s' % RASTER_BLOCK_SIZE, 'BLOCKYSIZE=%s' % RASTER_BLOCK_SIZE, 'COMPRESS=DEFLATE',
+        'COPY_SRC_OVERVIEWS=YES'])
+    out_raster = None
+    data = read_vsimem(geotiff)
+    gdal.Unlink(geotiff)
+    return data
+
+
+def get_overview_levels(shape, block):
+    levels = list()
+    factor = 2
+    while max(shape) // (factor // 2) > block:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def render_tile(geotiff, z, x, y, size, color):
+    # geotiff holds the bytes of an array2cog raster, gdal.Warp reads from the overview closest to the tile scale
+    source = '/vsimem/' + str(uuid.uuid4()) + '.tif'
+    gdal.FileFromMemBuffer(source, geotiff)
+    try:
+        tile = gdal.Warp('', source, format='MEM', outputBounds=get_tile_bounds(z, x, y), width=size, height=size,
+                         dstSRS='EPSG:3857', resampleAlg='near')
+        visible = tile.GetRasterBand(1).ReadAsArray() > 0
+        tile = None
+    finally:
+        gdal.Unlink(source)
+    return array2png(visible, color)
+
+
+def get_tile_bounds(z, x, y):
+    extent = 20037508.342789244
+    size = 2 * extent / pow(2, z)
+    return -extent + x * size, extent - (y + 1) * size, -extent + (x + 1) * size, extent - y * size
+
+
+def array2png(visible, color):
+    raster = get_driver('MEM').Create('', visible.shape[1], visible.shape[0], 4, gdal.GDT_Byte)
+    for i in range(4):
+        raster.GetRasterBand(i + 1).WriteArray(np.where(visible, color[i], 0).astype(np.uint8))
+    png = '/vsimem/' + str(uuid.uuid4()) + '.png'
+    out_raster = get_driver('PNG').CreateCopy(png, raster)
+    out_raster = None
+    data = read_vsimem(png)
+    gdal.Unlink(png)
+    return data
 
 
-def aggregate_masks(sectors):
-    mask = set()
-    for sector in sectors:
-        for p in sector:
-            mask.add(p)
-    return list(mask)
+def read_vsimem(path):
+    f = gdal.VSIFOpenL(path, 'rb')
+    gdal.VSIFSeekL(f, 0, 2)
+    size = gdal.VSIFTellL(f)
+    gdal.VSIFSeekL(f, 0, 0)
+    data = gdal.VSIFReadL(1, size, f)
+    gdal.VSIFCloseL(f)
+    return data
 
 
-def line_of_sight(line, array, vp, ha, empty, pxw, pxh, target_offset, earth_curvature, observer_height, earth_radius,
-                  refraction, k, esri):
-    half = list()
-    half.append(line[0])
+def line_of_sight(line, array, vp, ha, empty, mask, pxw, pxh, target_offset, earth_curvature, observer_height,
+                  earth_radius, refraction, k, esri):
     d0 = get_distance(line[0], vp)
     max_slope = get_slope(get_height(line[0], array) - get_earth_curvature(line[0], pxw, pxh, vp, earth_curvature,
                                                                            observer_height, earth_radius, esri) +
                           get_refraction(d0, refraction, k, earth_radius) + target_offset, ha, d0)
     empty[line[0][1]][line[0][0]] = max_slope
+    mask[line[0][1], line[0][0]] = 1
     for p in line[1:]:
         if np.isnan(empty[p[1]][p[0]]):
             d = get_distance(p, vp)
@@ -107,8 +682,8 @@ def line_of_sight(line, array, vp, ha, empty, pxw, pxh, target_offset, earth_cur
             slope = empty[p[1]][p[0]]
         if slope >= max_slope:
             max_slope = slope
-            half.append(p)
-    return half
+            mask[p[1], p[0]] = 1
+    return mask
 
 
 def get_distance(p1, p2):
@@ -148,13 +723,8 @@ def interpolate_coords(geotransform, e, _p, p1, p2):
     return x, y
 
 
-def get_empty(a):
-    a[a == 0] = np.NaN
-    return a
-
-
-def get_zeros(shape):
-    return np.zeros(shape)
+def get_mask(shape):
+    return np.zeros(shape, dtype=np.uint8)
 
 
 def get_bilinear_height(geotransform, pp, array, pt):
@@ -238,19 +808,437 @@ def pixel_offset2coord(geotransform, x_offset, y_offset):
     return coord_x, coord_y
 
 
-def calculate_viewshed(sectors, viewpoint, array, geotransform, earth_radius, observer, observer_height,
-                       earth_curvature, target_offset, refraction, k, esri):
+def calculate_viewshed(sectors, viewpoint, array, mask, ha, pxw, pxh, target_offset, earth_curvature, observer_height,
+                       earth_radius, refraction, k, esri, progress=None):
+    # The per-pixel loop, kept as the reference of the other engines: the slope of a sample is computed from its
+    # height when a ray first reaches it, none of the surfaces shared by the other engines are used
+    empty = np.full(array.shape, np.nan)
+    mask[viewpoint[1], viewpoint[0]] = 1
+    for i, sector in enumerate(sectors):
+        line_of_sight(sector, array, viewpoint, ha, empty, mask, pxw, pxh, target_offset, earth_curvature,
+                      observer_height, earth_radius, refraction, k, esri)
+        if progress is not None:
+            progress(i + 1, len(sectors))
+    return mask
+
+
+def calculate_viewshed_vectorized(sectors, viewpoint, surface, mask, progress=None):
+    mask[viewpoint[1], viewpoint[0]] = 1
+    for start in range(0, len(sectors), VECTORIZED_CHUNK):
+        chunk = sectors[start:start + VECTORIZED_CHUNK]
+        xs, ys, valid = pack_sectors(chunk)
+        visible = line_of_sight_vectorized(surface[ys, xs]) & valid
+        mask[ys[visible], xs[visible]] = 1
+        if progress is not None:
+            progress(min(start + VECTORIZED_CHUNK, len(sectors)), len(sectors))
+    return mask
+
+
+def calculate_viewshed_template(template, viewpoint, surface, progress=None):
+    mask = get_mask(surface.shape)
+    mask[viewpoint[1], viewpoint[0]] = 1
+    rays = len(template.lengths)
+    for start in range(0, rays, VECTORIZED_CHUNK):
+        xs, ys, valid = template.translate(viewpoint, start, start + VECTORIZED_CHUNK)
+        # Translated rays may overshoot the window by a pixel, those samples are dropped
+        valid &= (xs >= 0) & (xs < surface.shape[1]) & (ys >= 0) & (ys < surface.shape[0])
+        xs = np.where(valid, xs, viewpoint[0] + 1)
+        ys = np.where(valid, ys, viewpoint[1])
+        visible = line_of_sight_vectorized(np.where(valid, surface[ys, xs], np.nan)) & valid
+        mask[ys[visible], xs[visible]] = 1
+        if progress is not None:
+            progress(min(start + VECTORIZED_CHUNK, rays), rays)
+    return mask
+
+
+def calculate_viewshed_split(geotransform, observer, radius, viewpoint, surface, earth_radius=6371000.0,
+                             progress=None):
+    # Hierarchical ray splitting. Level 0 has just enough rays to reach every pixel of the innermost ring, each further
+    # level halves the azimuth step where the distance doubles, up to the auto swath on the outer ring. A new ray
+    # starts at its ring with the mean horizon of the two rays around it, instead of walking the pixels in front of
+    # it again. Returns the mask and the number of rays cast.
+    swath = get_auto_swath(geotransform, observer, radius, earth_radius)
+    outer = 1.0 / math.radians(swath)
+    levels = int(math.floor(math.log(outer / SWATH_SPLIT_RING, 2))) if outer > 2 * SWATH_SPLIT_RING else 0
+    # Rings as fractions of the view distance, every ray ends on the outer ring
+    rings = [0.5 ** (levels - i) for i in range(levels)]
+    mask = get_mask(surface.shape)
+    mask[viewpoint[1], viewpoint[0]] = 1
+    total = int(math.ceil(360.0 / (swath * 2 ** levels))) * 2 ** levels
+    done = 0
+    horizons = None
+    for level in range(levels + 1):
+        azimuths = get_azimuths(swath * 2 ** levels, level)
+        viewlines = get_viewlines(geotransform, observer, radius * np.cos(azimuths), radius * np.sin(azimuths),
+                                  viewpoint)
+        dx = np.array([line[2] - viewpoint[0] for line in viewlines], dtype=np.intp)
+        dy = np.array([line[3] - viewpoint[1] for line in viewlines], dtype=np.intp)
+        lengths = np.maximum(np.abs(dx), np.abs(dy))
+        starts = np.zeros(len(viewlines), dtype=np.intp)
+        inherited = None
+        if level == 0:
+            sectors = extract_masks(viewlines, viewpoint)
+        else:
+            starts = np.minimum(get_ring_index(dx, dy, rings[level - 1]), lengths - 1)
+            sectors = extract_tails(viewlines, viewpoint, starts)
+            inherited = (horizons + np.roll(horizons, -1, axis=0)) / 2.0
+        found = np.full((len(sectors), levels), -np.inf)
+        for first in range(0, len(sectors), VECTORIZED_CHUNK):
+            chunk = slice(first, first + VECTORIZED_CHUNK)
+            xs, ys, valid = pack_sectors(sectors[chunk])
+            slopes = surface[ys, xs]
+            horizon = None if inherited is None else inherited[chunk, level - 1]
+            visible = line_of_sight_vectorized(slopes, horizon) & valid
+            mask[ys[visible], xs[visible]] = 1
+            running = get_running_horizon(slopes, horizon)
+            rows = np.arange(len(running))
+            for ring in range(level, levels):
+                # The horizon of a ray at a ring is the highest slope in front of it
+                index = np.minimum(get_ring_index(dx[chunk], dy[chunk], rings[ring]), lengths[chunk] - 1) - \
+                    starts[chunk] - 1
+                before = -np.inf if horizon is None else horizon
+                found[chunk, ring] = np.where(index >= 0, running[rows, np.maximum(index, 0)], before)
+            done += len(running)
+            if progress is not None:
+                progress(done, total)
+        if horizons is None:
+            horizons = found
+        else:
+            horizons = np.insert(found, np.arange(len(horizons)), horizons, axis=0)
+    log.info('SPLIT SWATH: %s rays over %s levels, %s degree on the outer ring' % (total, levels + 1, swath))
+    return mask, total
+
+
+def calculate_pyramid_level(geotransform, matrix, observer, ha, inner, outer, azimuths, horizons, observer_height,
+                            target_offset, earth_curvature, refraction, k, earth_radius, esri, progress=None):
+    # One level of the pyramid viewshed: rays cross the ring from inner to outer (meter) on the slopes of a window
+    # around the viewpoint. horizons holds the slope each ray starts from, in pixels of this level, None for the
+    # innermost level whose rays start at the viewpoint. Returns the window geotransform, its mask and the horizon
+    # of every ray at the outer ring. Unlike the rest of the module, cells are placed at their centers here so that
+    # the viewpoint of every level is the cell holding the observer, whatever the cell size.
+    centers = (geotransform[0] + geotransform[1] / 2.0, geotransform[1], geotransform[2],
+               geotransform[3] + geotransform[5] / 2.0, geotransform[4], geotransform[5])
+    viewpoint = transform_coords(centers, observer[0], observer[1])
+    pxw = (math.pi * abs(geotransform[1]) * earth_radius) / 180.0
+    pxh = (math.pi * abs(geotransform[5]) * earth_radius) / 180.0
+    rings = int(math.ceil(outer / min(pxw * math.cos(math.radians(observer[1])), pxh))) + WINDOW_MARGIN
+    surface = get_slope_window(matrix, viewpoint, rings, ha, pxw, pxh, earth_curvature, observer_height,
+                               earth_radius, target_offset, refraction, k, esri)
+    center = (rings, rings)
+    window_geotransform = get_window_geotransform(geotransform, viewpoint, rings)
+    mask = get_mask(surface.shape)
+    ends = np.empty(len(azimuths))
+    try:
+        viewlines = get_viewlines(get_window_geotransform(centers, viewpoint, rings), observer,
+                                  outer * np.cos(azimuths), outer * np.sin(azimuths), center)
+        if horizons is None:
+            mask[center[1], center[0]] = 1
+            sectors = extract_masks(viewlines, center)
+        else:
+            dx = np.array([line[2] - center[0] for line in viewlines], dtype=np.intp)
+            dy = np.array([line[3] - center[1] for line in viewlines], dtype=np.intp)
+            lengths = np.maximum(np.abs(dx), np.abs(dy))
+            sectors = extract_tails(viewlines, center,
+                                    np.minimum(get_ring_index(dx, dy, inner / outer), lengths - 1))
+        for first in range(0, len(sectors), VECTORIZED_CHUNK):
+            chunk = slice(first, first + VECTORIZED_CHUNK)
+            xs, ys, valid = pack_sectors(sectors[chunk])
+            slopes = surface[ys, xs]
+            horizon = None if horizons is None else horizons[chunk]
+            visible = line_of_sight_vectorized(slopes, horizon) & valid
+            mask[ys[visible], xs[visible]] = 1
+            # Rays are padded with their first sample, so the last column holds the horizon at the end of each ray
+            ends[chunk] = get_running_horizon(slopes, horizon)[:, -1]
+            if progress is not None:
+                progress(min(first + VECTORIZED_CHUNK, len(sectors)), len(sectors))
+    finally:
+        release_slope_buffer(surface)
+    return window_geotransform, mask, ends
+
+
+def extract_tails(lines, viewpoint, starts):
+    # The samples of each line from index start on, drawn from that sample so that the pixels in front of it are
+    # never generated
+    sectors = list()
+    for l, start in zip(lines, starts):
+        major = float(max(abs(l[2] - viewpoint[0]), abs(l[3] - viewpoint[1])))
+        x = viewpoint[0] + int(round((start + 1) * (l[2] - viewpoint[0]) / major))
+        y = viewpoint[1] + int(round((start + 1) * (l[3] - viewpoint[1]) / major))
+        sectors.append(list(bresenham(x, y, l[2], l[3])))
+    return sectors
+
+
+def get_ring_index(dx, dy, ring):
+    # Index of the first Bresenham sample at least ring (a fraction of the ray) away from the viewpoint, which is not
+    # a sample. Sample i is i + 1 pixels away along the major axis.
+    major = np.maximum(np.abs(dx), np.abs(dy))
+    return np.maximum(np.ceil(ring * major).astype(np.intp) - 1, 0)
+
+
+def line_of_sight_vectorized(slopes, horizon=None):
+    # A sample is visible when its slope reaches the running maximum of all samples before it on the same ray,
+    # the first sample is always visible. NaN slopes (no data) are never visible and do not raise the horizon,
+    # unless they are the first sample, in which case nothing further along the ray is visible. horizon, when given,
+    # is the slope each ray has to reach from its first sample on, for rays starting away from the viewpoint.
+    nodata = np.isnan(slopes)
+    running = get_running_horizon(slopes, horizon)
+    visible = np.ones(slopes.shape, dtype=bool)
+    if horizon is not None:
+        visible[:, 0] = slopes[:, 0] >= horizon
+    visible[:, 1:] = slopes[:, 1:] >= running[:, :-1]
+    visible[:, 1:] &= ~nodata[:, 1:]
+    return visible
+
+
+def get_running_horizon(slopes, horizon=None):
+    # Highest slope of every ray up to and including each sample
+    nodata = np.isnan(slopes)
+    running = np.where(nodata, -np.inf, slopes)
+    if horizon is None:
+        running[:, 0] = np.where(nodata[:, 0], np.inf, slopes[:, 0])
+    else:
+        running[:, 0] = np.maximum(running[:, 0], horizon)
+    return np.maximum.accumulate(running, axis=1)
+
+
+def pack_sectors(sectors):
+    # Pack variable length rays into (rays, samples) index arrays, padded with the first sample of each ray.
+    lengths = np.array([len(sector) for sector in sectors], dtype=np.intp)
+    starts = np.cumsum(lengths) - lengths
+    points = np.array([p for sector in sectors for p in sector], dtype=np.intp).reshape(-1, 2)
+    rows = np.repeat(np.arange(len(sectors)), lengths)
+    cols = np.arange(len(points)) - np.repeat(starts, lengths)
+    xs = np.repeat(points[starts, 0][:, np.newaxis], lengths.max(), axis=1)
+    ys = np.repeat(points[starts, 1][:, np.newaxis], lengths.max(), axis=1)
+    xs[rows, cols] = points[:, 0]
+    ys[rows, cols] = points[:, 1]
+    valid = np.zeros(xs.shape, dtype=bool)
+    valid[rows, cols] = True
+    return xs, ys, valid
+
+
+def get_distance_array(xs, ys, vp):
+    return np.sqrt(np.square(vp[0] - xs) + np.square(vp[1] - ys))
+
+
+def get_earth_curvature_array(xs, ys, pxw, pxh, vp, earth_curvature, observer_height, earth_radius, esri):
+    h1 = 0.0
+    if earth_curvature:
+        d0 = np.sqrt(np.square((xs - vp[0]) * pxw) + np.square((ys - vp[1]) * pxh))
+        if esri:
+            h1 = np.square(d0) / (2 * earth_radius)
+        else:
+            d1 = math.sqrt(pow(observer_height, 2) + 2 * earth_radius * observer_height)
+            h1 = np.sqrt(np.square(d0 - d1) + pow(earth_radius, 2)) - earth_radius
+    return h1
+
+
+def calculate_viewshed_sweep(viewpoint, array, geotransform, earth_radius, observer, observer_height, radius,
+                             earth_curvature, target_offset, refraction, k, esri, progress=None):
+    # Ring by ring sweep (XDraw): every cell within the radius is visited once, its horizon is interpolated from
+    # the two cells of the previous ring that bracket its line of sight back to the viewpoint.
     pxw = (math.pi * abs(geotransform[1]) * earth_radius) / 180.0
     pxh = (math.pi * abs(geotransform[5]) * earth_radius) / 180.0
     ha = get_bilinear_height(geotransform, viewpoint, array, observer) + observer_height
-    empty = get_empty(get_zeros(array.shape))
-    t_los = list()
-    for sector in sectors:
-        los = line_of_sight(sector, array, viewpoint, ha, empty, pxw, pxh, target_offset, earth_curvature,
-                            observer_height, earth_radius, refraction, k, esri)
-        los.append(viewpoint)
-        t_los.append(sorted(los))
-    return t_los
+    mx = pxw * math.cos(math.radians(observer[1]))
+    rings = int(math.ceil(radius / min(mx, pxh)))
+    slopes = get_slope_window(array, viewpoint, rings, ha, pxw, pxh, earth_curvature, observer_height, earth_radius,
+                              target_offset, refraction, k, esri)
+    try:
+        visible = sweep_window(slopes, rings, progress)
+    finally:
+        release_slope_buffer(slopes)
+    dy, dx = np.mgrid[-rings:rings + 1, -rings:rings + 1]
+    visible &= np.square(dx * mx) + np.square(dy * pxh) <= pow(radius, 2)
+    return put_window(get_mask(array.shape), viewpoint, rings, visible)
+
+
+def sweep_window(slopes, rings, progress=None):
+    horizon = np.empty(slopes.shape)
+    horizon[rings, rings] = SWEEP_HORIZON_FLOOR
+    visible = np.zeros(slopes.shape, dtype=bool)
+    visible[rings, rings] = True
+    for r in range(1, rings + 1):
+        u, v = get_ring(r)
+        major_x = np.abs(u) >= np.abs(v)
+        t = np.where(major_x, v, u) * (r - 1.0) / r
+        lo = np.floor(t).astype(np.intp)
+        hi = np.ceil(t).astype(np.intp)
+        w = t - lo
+        pu = np.where(major_x, u - np.sign(u), 0) + rings
+        pv = np.where(major_x, 0, v - np.sign(v)) + rings
+        h = (1.0 - w) * horizon[np.where(major_x, pv + lo, pv), np.where(major_x, pu, pu + lo)] + \
+            w * horizon[np.where(major_x, pv + hi, pv), np.where(major_x, pu, pu + hi)]
+        s = slopes[v + rings, u + rings]
+        nodata = np.isnan(s)
+        visible[v + rings, u + rings] = (s >= h) & ~nodata
+        horizon[v + rings, u + rings] = np.where(nodata, h, np.maximum(h, s))
+        if progress is not None:
+            progress(r, rings)
+    return visible
+
+
+def get_ring(r):
+    side = np.arange(-r, r + 1)
+    edge = np.repeat(r, side.size)
+    u = np.concatenate((side, side, -edge[1:-1], edge[1:-1]))
+    v = np.concatenate((-edge, edge, side[1:-1], side[1:-1]))
+    return u, v
+
+
+def get_window_bounds(shape, vp, rings):
+    x0 = vp[0] - rings
+    y0 = vp[1] - rings
+    x1 = min(vp[0] + rings + 1, shape[1])
+    y1 = min(vp[1] + rings + 1, shape[0])
+    return x0, y0, max(x0, 0), max(y0, 0), x1, y1
+
+
+def get_window_geotransform(geotransform, vp, rings):
+    return (geotransform[0] + (vp[0] - rings) * geotransform[1], geotransform[1], geotransform[2],
+            geotransform[3] + (vp[1] - rings) * geotransform[5], geotransform[4], geotransform[5])
+
+
+def get_height_window(array, vp, rings):
+    # Heights of the window around the viewpoint, NaN outside the DEM. The buffer goes back to the pool through
+    # release_slope_buffer.
+    heights = get_slope_buffer((2 * rings + 1, 2 * rings + 1))
+    heights.fill(np.nan)
+    x0, y0, sx0, sy0, sx1, sy1 = get_window_bounds(array.shape, vp, rings)
+    heights[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = array[sy0:sy1, sx0:sx1]
+    return heights
+
+
+def get_slope_window(array, vp, rings, ha, pxw, pxh, earth_curvature, observer_height, earth_radius, target_offset,
+                     refraction, k, esri):
+    # Slope from the observer to every cell of the window around the viewpoint, NaN outside the DEM. Heights are
+    # corrected in place with surfaces shared by every observer of the same window geometry, so rays only gather
+    # their samples. The buffer goes back to the pool through release_slope_buffer.
+    d, curvature, refracted = get_corrections(rings, pxw, pxh, earth_curvature, observer_height, earth_radius,
+                                              refraction, k, esri)
+    slopes = get_height_window(array, vp, rings)
+    if curvature is not None:
+        slopes -= curvature
+    if refracted is not None:
+        slopes += refracted
+    slopes += target_offset
+    slopes -= ha
+    slopes /= d
+    return slopes
+
+
+def get_corrections(rings, pxw, pxh, earth_curvature, observer_height, earth_radius, refraction, k, esri):
+    # Distance to the center of the window (1.0 at the center itself), and the curvature and refraction corrections
+    # of every cell, None when not applied. They only depend on the window geometry.
+    key = (rings, pxw, pxh, earth_curvature, observer_height, earth_radius, refraction, k, esri)
+    with correction_lock:
+        surfaces = corrections.pop(key, None)
+        if surfaces is not None:
+            corrections[key] = surfaces
+            return surfaces
+    dy, dx = np.mgrid[-rings:rings + 1, -rings:rings + 1]
+    d = get_distance_array(dx, dy, (0, 0))
+    d[rings, rings] = 1.0
+    curvature = None
+    if earth_curvature:
+        curvature = get_earth_curvature_array(dx, dy, pxw, pxh, (0, 0), earth_curvature, observer_height,
+                                              earth_radius, esri)
+    refracted = get_refraction(d, refraction, k, earth_radius) if refraction else None
+    surfaces = (d, curvature, refracted)
+    with correction_lock:
+        corrections[key] = surfaces
+        while len(corrections) > CORRECTION_CACHE_SIZE:
+            corrections.popitem(last=False)
+    return surfaces
+
+
+def get_slope_buffer(shape):
+    with slope_buffer_lock:
+        buffers = slope_buffers.get(shape)
+        if buffers:
+            return buffers.pop()
+    return np.empty(shape, dtype=np.float64)
+
+
+def release_slope_buffer(buffer):
+    # The least recently released sizes are dropped first once the pool is full
+    with slope_buffer_lock:
+        buffers = slope_buffers.pop(buffer.shape, list())
+        buffers.append(buffer)
+        slope_buffers[buffer.shape] = buffers
+        while sum(len(buffers) for buffers in slope_buffers.values()) > SLOPE_BUFFER_POOL_SIZE:
+            oldest = next(iter(slope_buffers))
+            slope_buffers[oldest].pop()
+            if not slope_buffers[oldest]:
+                del slope_buffers[oldest]
+
+
+def put_window(array, vp, rings, window):
+    x0, y0, sx0, sy0, sx1, sy1 = get_window_bounds(array.shape, vp, rings)
+    array[sy0:sy1, sx0:sx1] = window[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0]
+    return array
+
+
+class RayTemplate(object):
+    """
+    Bresenham rays of one viewshed as pixel offsets from the viewpoint, padded to (rays, samples) int16 arrays, or
+    int32 arrays when an offset is out of the int16 range, as for long view distances or near the poles. Rays are
+    sorted longest first so that a chunk of rays is only as wide as its first ray, order holds the viewline index of
+    every ray. Sample distances are not stored, rays read slopes from a window whose distances are shared by every
+    observer of the same geometry.
+    """
+
+    def __init__(self, sectors):
+        lengths = np.array([len(sector) for sector in sectors], dtype=np.int32)
+        self.order = np.argsort(-lengths, kind='mergesort').astype(np.int32)
+        self.lengths = lengths[self.order]
+        xs, ys, valid = pack_sectors([sectors[i] for i in self.order])
+        reach = max(np.abs(xs).max(), np.abs(ys).max()) if xs.size else 0
+        dtype = np.int16 if reach <= np.iinfo(np.int16).max else np.int32
+        self.dx = xs.astype(dtype)
+        self.dy = ys.astype(dtype)
+
+    def translate(self, vp, start, stop):
+        # Offsets are widened before the viewpoint is added, int16 plus a scalar stays int16 and anything derived
+        # from the result, such as squared distances, would overflow
+        width = self.lengths[start] if start < len(self.lengths) else 0
+        dx = self.dx[start:stop, :width].astype(np.intp)
+        dy = self.dy[start:stop, :width].astype(np.intp)
+        valid = np.arange(width) < self.lengths[start:stop][:, np.newaxis]
+        return dx + vp[0], dy + vp[1], valid
+
+    def nbytes(self):
+        return self.dx.nbytes + self.dy.nbytes + self.lengths.nbytes + self.order.nbytes
+
+
+def get_ray_template(geotransform, observer, radius, use_swath, swath, earth_radius=6371000.0):
+    # Templates are built at the center of a RAY_TEMPLATE_BAND degrees latitude band, away from it the longitude
+    # pixel size changes with cos(latitude) and the ray endpoints drift, past RAY_TEMPLATE_TOLERANCE pixels the
+    # template is not used and the rays are computed for the observer
+    band = int(math.floor(observer[1] / RAY_TEMPLATE_BAND))
+    latitude = (band + 0.5) * RAY_TEMPLATE_BAND
+    endpoint = radius / (math.radians(abs(geotransform[1])) * earth_radius * math.cos(math.radians(observer[1])))
+    drift = endpoint * abs(math.cos(math.radians(latitude)) / math.cos(math.radians(observer[1])) - 1.0)
+    if drift > RAY_TEMPLATE_TOLERANCE:
+        log.info('RAY TEMPLATE: endpoint drift %s pixels at latitude %s, computing rays' % (drift, observer[1]))
+        return None
+    key = (abs(geotransform[1]), abs(geotransform[5]), radius, use_swath, swath, band, earth_radius)
+    with ray_template_lock:
+        template = ray_templates.pop(key, None)
+        if template is not None:
+            ray_templates[key] = template
+            return template
+    # The reference observer sits exactly on pixel (0, 0), so the Bresenham pixels are the offsets themselves
+    reference = (observer[0], geotransform[1], geotransform[2], latitude, geotransform[4], geotransform[5])
+    viewlines = calculate_viewlines(reference, (observer[0], latitude), radius, use_swath, swath, (0, 0),
+                                    earth_radius)
+    template = RayTemplate(extract_masks(viewlines, (0, 0)))
+    log.info('RAY TEMPLATE: %s rays, %s bytes' % (len(template.lengths), template.nbytes()))
+    with ray_template_lock:
+        ray_templates[key] = template
+        while len(ray_templates) > RAY_TEMPLATE_CACHE_SIZE:
+            ray_templates.popitem(last=False)
+    return template
 
 
 def extract_masks(lines, viewpoint):
@@ -262,25 +1250,58 @@ def extract_masks(lines, viewpoint):
     return sectors
 
 
+def get_srs():
+    # Shared by every request, callers only read it
+    global wgs84_srs
+    if wgs84_srs is None:
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(int(code[1]))
+        wgs84_srs = srs
+    return wgs84_srs
+
+
+def get_driver(name):
+    # GDAL raster drivers by name, and the OGR Memory driver
+    if name not in drivers:
+        drivers[name] = ogr.GetDriverByName(name) if name == 'Memory' else gdal.GetDriverByName(name)
+    return drivers[name]
+
+
+def get_wgs84():
+    global wgs84
+    if wgs84 is None:
+        wgs84 = Proj(init='epsg:' + code[1])
+    return wgs84
+
+
 def get_aeqd(lon, lat):
-    return Proj(proj='aeqd', ellps='WGS84', datum='WGS84', lat_0=lat, lon_0=lon, units='m', preserve_units=True)
+    # Projections are cached per observer, the bbox and the viewlines of one request share the same one
+    key = (lon, lat)
+    with aeqd_lock:
+        p = aeqd_cache.pop(key, None)
+        if p is None:
+            p = Proj(proj='aeqd', ellps='WGS84', datum='WGS84', lat_0=lat, lon_0=lon, units='m', preserve_units=True)
+        aeqd_cache[key] = p
+        while len(aeqd_cache) > AEQD_CACHE_SIZE:
+            aeqd_cache.popitem(last=False)
+    return p
 
 
-def calculate_viewlines(geotransform, observer, radius, use_swath, swath, vp):
-    p1 = Proj(init='epsg:' + code[1])
-    p2 = get_aeqd(observer[0], observer[1])
-    lines = list()
+def calculate_viewlines(geotransform, observer, radius, use_swath, swath, vp, earth_radius=6371000.0):
+    # Ray endpoints are generated in the azimuthal equidistant plane of the observer first, then reprojected and
+    # converted to pixel offsets in one vectorized call each
+    if use_swath and swath in SWATH_MODES:
+        azimuths = get_azimuths(get_auto_swath(geotransform, observer, radius, earth_radius))
+        return get_viewlines(geotransform, observer, radius * np.cos(azimuths), radius * np.sin(azimuths), vp)
+    xs = list()
+    ys = list()
     if use_swath:
         theta = 0.0
         while theta < math.degrees(math.pi) - 1.0:
             left = math.radians(theta) + (math.pi / 2)
             right = math.radians(theta) - (math.pi / 2)
-            l_x, l_y = transform(p2, p1, x=radius * math.cos(left), y=radius * math.sin(left))
-            r_x, r_y = transform(p2, p1, x=radius * math.cos(right), y=radius * math.sin(right))
-            l_u, l_v = transform_coords(geotransform, l_x, l_y)
-            r_u, r_v = transform_coords(geotransform, r_x, r_y)
-            lines.append((vp[0], vp[1], l_u, l_v))
-            lines.append((vp[0], vp[1], r_u, r_v))
+            xs.extend((radius * math.cos(left), radius * math.cos(right)))
+            ys.extend((radius * math.sin(left), radius * math.sin(right)))
             theta += swath
     else:
         f = 1 - radius
@@ -288,18 +1309,8 @@ def calculate_viewlines(geotransform, observer, radius, use_swath, swath, vp):
         ddf_y = -2 * radius
         x = 0
         y = radius
-        u1, v1 = transform(p2, p1, x=0.0, y=radius)
-        u2, v2 = transform(p2, p1, x=0.0, y=-radius)
-        u3, v3 = transform(p2, p1, x=radius, y=0)
-        u4, v4 = transform(p2, p1, x=-radius, y=0)
-        _u1, _v1 = transform_coords(geotransform, u1, v1)
-        _u2, _v2 = transform_coords(geotransform, u2, v2)
-        _u3, _v3 = transform_coords(geotransform, u3, v3)
-        _u4, _v4 = transform_coords(geotransform, u4, v4)
-        lines.append((vp[0], vp[1], _u1, _v1))
-        lines.append((vp[0], vp[1], _u2, _v2))
-        lines.append((vp[0], vp[1], _u3, _v3))
-        lines.append((vp[0], vp[1], _u4, _v4))
+        xs.extend((0.0, 0.0, radius, -radius))
+        ys.extend((radius, -radius, 0, 0))
         while x < y:
             if f >= 0:
                 y -= 1
@@ -308,90 +1319,153 @@ def calculate_viewlines(geotransform, observer, radius, use_swath, swath, vp):
             x += 1
             ddf_x += 2
             f += ddf_x
-            a1, b1 = transform(p2, p1, x=x, y=y)
-            a2, b2 = transform(p2, p1, x=-x, y=y)
-            a3, b3 = transform(p2, p1, x=x, y=-y)
-            a4, b4 = transform(p2, p1, x=-x, y=-y)
-            a5, b5 = transform(p2, p1, x=y, y=x)
-            a6, b6 = transform(p2, p1, x=-y, y=x)
-            a7, b7 = transform(p2, p1, x=y, y=-x)
-            a8, b8 = transform(p2, p1, x=-y, y=-x)
-            _a1, _b1 = transform_coords(geotransform, a1, b1)
-            _a2, _b2 = transform_coords(geotransform, a2, b2)
-            _a3, _b3 = transform_coords(geotransform, a3, b3)
-            _a4, _b4 = transform_coords(geotransform, a4, b4)
-            _a5, _b5 = transform_coords(geotransform, a5, b5)
-            _a6, _b6 = transform_coords(geotransform, a6, b6)
-            _a7, _b7 = transform_coords(geotransform, a7, b7)
-            _a8, _b8 = transform_coords(geotransform, a8, b8)
-            lines.append((vp[0], vp[1], _a1, _b1))
-            lines.append((vp[0], vp[1], _a2, _b2))
-            lines.append((vp[0], vp[1], _a3, _b3))
-            lines.append((vp[0], vp[1], _a4, _b4))
-            lines.append((vp[0], vp[1], _a5, _b5))
-            lines.append((vp[0], vp[1], _a6, _b6))
-            lines.append((vp[0], vp[1], _a7, _b7))
-            lines.append((vp[0], vp[1], _a8, _b8))
-    return lines
+            xs.extend((x, -x, x, -x, y, -y, y, -y))
+            ys.extend((y, y, -y, -y, x, x, -x, -x))
+    return get_viewlines(geotransform, observer, np.array(xs, dtype=np.float64), np.array(ys, dtype=np.float64), vp)
+
+
+def get_viewlines(geotransform, observer, xs, ys, vp):
+    lon, lat = transform(get_aeqd(observer[0], observer[1]), get_wgs84(), x=xs, y=ys)
+    u, v = transform_coords(geotransform, lon, lat)
+    return [(vp[0], vp[1], _u, _v) for _u, _v in zip(u.tolist(), v.tolist())]
+
+
+def get_auto_swath(geotransform, observer, radius, earth_radius=6371000.0):
+    # Largest azimuth step (degree) that leaves no more than one pixel between neighbouring ray ends on the outer
+    # ring, measured on the narrower side of the pixel
+    pixel = min(math.radians(abs(geotransform[1])) * earth_radius * math.cos(math.radians(observer[1])),
+                math.radians(abs(geotransform[5])) * earth_radius)
+    return math.degrees(pixel / radius)
+
+
+def get_azimuths(swath, level=0):
+    # Azimuths (radian) around the whole circle, swath degrees apart at most. At level n the step is halved n times
+    # and only the rays added by the last halving are returned, at odd multiples of the step.
+    count = int(math.ceil(360.0 / swath))
+    if level == 0:
+        return 2 * math.pi * np.arange(count) / count
+    count *= 2 ** level
+    return 2 * math.pi * (2 * np.arange(count // 2) + 1) / count
+
+
+def get_pyramid_distances(radius):
+    # Outer distance (meter) of every pyramid level, the full resolution one reaches PYRAMID_BASE_DISTANCE and each
+    # further level twice as far as the one before it, the last one stops at radius
+    distances = [min(PYRAMID_BASE_DISTANCE, radius)]
+    while distances[-1] < radius:
+        distances.append(min(distances[-1] * 2, radius))
+    return distances
+
+
+def snap_coords(longitude, latitude, pixel_size):
+    return round((math.floor(longitude / pixel_size) + 0.5) * pixel_size, 9), \
+        round((math.floor(latitude / pixel_size) + 0.5) * pixel_size, 9)
 
 
 def transform_coords(geotransform, longitude, latitude):
+    if np.ndim(longitude) > 0:
+        return round_half_away(((longitude - geotransform[0]) / abs(geotransform[1]))), \
+               round_half_away(((geotransform[3] - latitude) / abs(geotransform[5])))
     return int(round(((longitude - geotransform[0]) / abs(geotransform[1])), 0)), \
            int(round(((geotransform[3] - latitude) / abs(geotransform[5])), 0))
+
+
+def round_half_away(a):
+    # Same rounding as the built-in round() on scalars, np.round rounds half to even
+    return (np.sign(a) * np.floor(np.abs(a) + 0.5)).astype(np.intp)
     
     
-def read_image(geotiff):
+def read_image(geotiff, bbox=None):
+    # Reads band 1 as float32, only the window covering bbox (min_x, min_y, max_x, max_y) when given, and skips the
+    # statistics pass: the viewshed needs neither the whole band nor its statistics. geotiff is a path or a dataset
+    # already open.
     try:
-        raster = gdal.Open(geotiff)
+        raster = gdal.Open(geotiff) if isinstance(geotiff, basestring) else geotiff
+        if raster is None:
+            raise RuntimeError('%s cannot be opened' % geotiff)
         geotransform = raster.GetGeoTransform()
+        srcband = raster.GetRasterBand(1)
+        if srcband is None:
+            log.info("ERROR: can't get band")
+            return
+        xoff, yoff, xsize, ysize = get_read_window(geotransform, raster.RasterXSize, raster.RasterYSize, bbox)
+        matrix = srcband.ReadAsArray(xoff, yoff, xsize, ysize, buf_type=gdal.GDT_Float32)
+        geotransform = (geotransform[0] + xoff * geotransform[1], geotransform[1], geotransform[2],
+                        geotransform[3] + yoff * geotransform[5], geotransform[4], geotransform[5])
         log.info("[ METADATA ] =  x_min=%s, pixel_width=%s, y_max=%s, pixel_height=%s" % (geotransform[0],
                                                                                           geotransform[1],
                                                                                           geotransform[3],
                                                                                           geotransform[5]))
-        max_distance = math.ceil(math.sqrt(2 * geotransform[1] * geotransform[1]))
-        log.info("[ MAX DISTANCE ] = %s", max_distance)
-        log.info("[ RASTER BAND COUNT ]: %s", raster.RasterCount)
-        for band in range(raster.RasterCount):
-            band += 1
-            log.info("[ GETTING BAND ]: %s", band)
-            srcband = raster.GetRasterBand(band)
-            if srcband is None:
-                log.info("ERROR: can't get band")
-                break
-            stats = srcband.GetStatistics(True, True)
-            if stats is None:
-                log.info("ERROR: can't get statistics")
-                break
-            matrix = srcband.ReadAsArray()
-            log.info("[ DEMENSION ] Rows=%s, Columns=%s", matrix.shape[0], matrix.shape[1])
-            log.info("[ STATS ] =  Minimum=%s, Maximum=%s, Mean=%s, StdDev=%s" % (stats[0],
-                                                                                  stats[1],
-                                                                                  stats[2],
-                                                                                  stats[3]))
-            log.info("[ NO DATA VALUE ] = %s", srcband.GetNoDataValue())
-            log.info("[ SCALE ] = %s", srcband.GetScale())
-            log.info("[ UNIT TYPE ] = %s", srcband.GetUnitType())
-            ctable = srcband.GetColorTable()
-            if ctable is None:
-                log.info('No ColorTable found')
-            else:
-                log.info("[ COLOR TABLE COUNT ] = ", ctable.GetCount())
-                for i in range(0, ctable.GetCount()):
-                    entry = ctable.GetColorEntry(i)
-                    if not entry:
-                        continue
-                    log.info("[ COLOR ENTRY RGB ] = ", ctable.GetColorEntryAsRGB(i, entry))
-            return geotransform, matrix
+        log.info("[ DEMENSION ] Rows=%s, Columns=%s, Bytes read=%s", matrix.shape[0], matrix.shape[1],
+                 matrix.nbytes)
+        return geotransform, matrix
     except RuntimeError, e:
+        # Raised rather than exiting: the request or job thread reading the DEM fails, not the worker
         log.info('Unable to open INPUT.tif')
         log.info(e)
-        sys.exit(1)
+        raise IOError('DEM cannot be read: %s' % e)
+
+
+def get_read_window(geotransform, cols, rows, bbox):
+    if bbox is None:
+        return 0, 0, cols, rows
+    # One pixel of margin keeps the neighbors used by the bilinear observer height inside the window
+    x0 = int(math.floor((bbox[0] - geotransform[0]) / geotransform[1])) - 1
+    x1 = int(math.ceil((bbox[2] - geotransform[0]) / geotransform[1])) + 1
+    y0 = int(math.floor((bbox[3] - geotransform[3]) / geotransform[5])) - 1
+    y1 = int(math.ceil((bbox[1] - geotransform[3]) / geotransform[5])) + 1
+    x0, y0 = max(x0, 0), max(y0, 0)
+    x1, y1 = min(x1, cols), min(y1, rows)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def read_pyramid_level(geotiff, observer, distance, pixel_size, factor):
+    # Block maximum of the DEM around the observer out to distance, at factor times its pixel size, with the
+    # observer at the center of a cell. An occluder is never lower than the full resolution cells it covers, so a
+    # coarse level never lowers the horizon carried through it and a coarse cell is visible when its highest ground
+    # is. Cells off the DEM are NaN.
+    cell = (abs(pixel_size[0]) * factor, abs(pixel_size[1]) * factor)
+    min_x, min_y, max_x, max_y = viewshed_bbox(observer[0], observer[1], distance)
+    half_x = (math.ceil(max(observer[0] - min_x, max_x - observer[0]) / cell[0]) + 0.5) * cell[0]
+    half_y = (math.ceil(max(observer[1] - min_y, max_y - observer[1]) / cell[1]) + 0.5) * cell[1]
+    bounds = (observer[0] - half_x, observer[1] - half_y, observer[0] + half_x, observer[1] + half_y)
+    # Overviews are skipped, they are averaged and would lower ridges before the maximum is taken
+    raster = gdal.Warp('', geotiff, format='MEM', outputBounds=bounds, xRes=cell[0], yRes=cell[1], resampleAlg='max',
+                       outputType=gdal.GDT_Float32, dstNodata=float('nan'), options=['-ovr', 'NONE'])
+    heights = raster.GetRasterBand(1).ReadAsArray()
+    log.info("[ PYRAMID ] factor=%s, Rows=%s, Columns=%s", factor, heights.shape[0], heights.shape[1])
+    return raster.GetGeoTransform(), heights
+
+
+def get_relief_bias(matrix, factor):
+    # How much higher the block maximum is than the block average on the mean (meter), the height given to the
+    # ground by cells of factor times the full resolution. Measured on the full resolution level, which is already in
+    # memory, rather than on the ring of the level with a second warp.
+    rows, cols = matrix.shape[0] // factor * factor, matrix.shape[1] // factor * factor
+    if rows == 0 or cols == 0:
+        return 0.0
+    blocks = matrix[:rows, :cols].reshape(rows // factor, factor, cols // factor, factor).swapaxes(1, 2)
+    blocks = blocks.reshape(rows // factor, cols // factor, factor * factor)
+    valid = ~np.isnan(blocks).all(axis=2)
+    if not valid.any():
+        return 0.0
+    return float(np.mean(np.nanmax(blocks[valid], axis=1) - np.nanmean(blocks[valid], axis=1)))
+
+
+def viewshed_bbox(x, y, distance):
+    p1 = get_wgs84()
+    p2 = get_aeqd(x, y)
+    buffer_distance = distance * 1.1
+    min_x, min_y = transform(p2, p1, x=0.0 - buffer_distance, y=0.0 - buffer_distance)
+    max_x, max_y = transform(p2, p1, x=0.0 + buffer_distance, y=0.0 + buffer_distance)
+    return min_x, min_y, max_x, max_y
 
 
 def viewshed_payload(min_x, min_y, max_x, max_y, resolution):
-    layer = DEM_30METERS
-    if resolution == 10:
-        layer = DEM_10METERS
+    return coverage_payload(get_layer(resolution), min_x, min_y, max_x, max_y)
+
+
+def coverage_payload(layer, min_x, min_y, max_x, max_y):
     querystring = {
         "service": "WCS",
         "version": WCS_VERSION,
@@ -401,3 +1475,10 @@ def viewshed_payload(min_x, min_y, max_x, max_y, resolution):
         "Format": "image/tiff"
     }
     return querystring
+
+
+def get_layer(resolution):
+    layer = DEM_30METERS
+    if resolution == 10:
+        layer = DEM_10METERS
+    return layer
@@ -0,0 +1,341 @@
+import os
+import json
+import math
+import hashlib
+import uuid
+import logging
+import threading
+from osgeo import gdal
+from collections import OrderedDict
+from mvc.modeller.algorithm import coverage_payload
+from mvc.modeller.wcs import wcs_client
+from mvc.modeller.metrics import metrics
+from setting import DEM_CACHE_DIR, DEM_CACHE_SIZE_LIMIT, DEM_CACHE_TILE_SIZE, RESULT_CACHE_DIR, \
+    RESULT_CACHE_SIZE_LIMIT, RESULT_CACHE_DISK_LIMIT, RESULT_CACHE_VERSION, DEM_FETCH_MARGIN
+
+log = logging.getLogger(__name__)
+
+
+class DemTileCache(object):
+    """
+    On-disk DEM tiles on a fixed grid per coverage, evicted least recently used first past size_limit bytes. Every
+    gunicorn worker shares the folder, so tiles may vanish under a worker at any time: recency is the tile mtime and
+    eviction scans the folder, the size limit holds for all workers together. hits, misses and evictions are counted
+    per process.
+    """
+
+    def __init__(self, client, cache_dir, size_limit, tile_size):
+        self.client = client
+        self.cache_dir = cache_dir
+        self.size_limit = size_limit
+        self.tile_size = tile_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                pass
+        self.evict()
+
+    def fetch(self, layer, min_x, min_y, max_x, max_y, target):
+        tiles = list()
+        for col, row in self.get_tile_range(layer, min_x, min_y, max_x, max_y):
+            tile = self.get_tile(layer, col, row)
+            if tile is None:
+                return None
+            tiles.append(tile)
+        # Tiles are open datasets, they stay readable even when another worker evicts their files meanwhile
+        mosaic = '/vsimem/' + str(uuid.uuid4()) + '.vrt'
+        vrt = gdal.BuildVRT(mosaic, tiles)
+        gdal.Translate(target, vrt, format='GTiff', projWin=[min_x, max_y, max_x, min_y])
+        vrt = None
+        gdal.Unlink(mosaic)
+        return target
+
+    def get_tile_range(self, layer, min_x, min_y, max_x, max_y):
+        size = self.tile_size[layer]
+        for col in range(int(math.floor(min_x / size)), int(math.floor(max_x / size)) + 1):
+            for row in range(int(math.floor(min_y / size)), int(math.floor(max_y / size)) + 1):
+                yield col, row
+
+    def get_tile_path(self, layer, col, row):
+        return os.path.join(self.cache_dir, layer.replace(':', '__'), '%s_%s.tif' % (col, row))
+
+    def get_tile(self, layer, col, row):
+        # Returns the tile as an open dataset, a tile whose file is missing or unreadable is a miss
+        path = self.get_tile_path(layer, col, row)
+        dataset = None
+        if os.path.exists(path):
+            try:
+                os.utime(path, None)
+                dataset = gdal.Open(path)
+            except (OSError, RuntimeError):
+                dataset = None
+        with self.lock:
+            if dataset is not None:
+                self.hits += 1
+                return dataset
+            self.misses += 1
+        size = self.tile_size[layer]
+        querystring = coverage_payload(layer, col * size, row * size, (col + 1) * size, (row + 1) * size)
+        content = self.client.get_coverage(querystring)
+        if content is None:
+            log.info('DEM tile %s/%s_%s failed' % (layer, col, row))
+            return None
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+            part = path + '.' + str(uuid.uuid4())
+            with open(part, 'wb') as f:
+                f.write(content)
+            # Opened before it is renamed into place, so that an eviction right after cannot take it away
+            dataset = gdal.Open(part)
+            os.rename(part, path)
+        except (IOError, OSError) as e:
+            log.info('DEM tile %s/%s_%s not cached: %s' % (layer, col, row, e))
+            if dataset is None:
+                return None
+        self.evict()
+        return dataset
+
+    def scan(self):
+        # (mtime, path, size) of the tiles of every worker, least recently used first
+        found = list()
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.tif'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    found.append((stat.st_mtime, path, stat.st_size))
+        return sorted(found)
+
+    def evict(self):
+        found = self.scan()
+        size = sum(tile[2] for tile in found)
+        for mtime, path, tile_size in found[:-1]:
+            if size <= self.size_limit:
+                break
+            size -= tile_size
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            with self.lock:
+                self.evictions += 1
+
+    def stats(self):
+        found = self.scan()
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "tiles": len(found),
+                "size": sum(tile[2] for tile in found),
+                "size_limit": self.size_limit
+            }
+
+
+class DemFlight(object):
+    def __init__(self, layer, bbox):
+        self.layer = layer
+        self.bbox = bbox
+        self.path = '/vsimem/' + str(uuid.uuid4()) + '.tif'
+        self.fetched = False
+        self.users = 1
+        self.done = threading.Event()
+
+    def covers(self, layer, bbox):
+        return self.layer == layer and self.bbox[0] <= bbox[0] and self.bbox[1] <= bbox[1] and \
+            bbox[2] <= self.bbox[2] and bbox[3] <= self.bbox[3]
+
+
+class DemFlights(object):
+    """
+    Single-flight DEM fetches: a fetch whose bbox lies inside one already in flight waits for it and slices its window
+    out of the shared result instead of requesting its own. Fetches are padded by margin degrees so that nearby
+    observers fall inside each other's flight.
+    """
+
+    def __init__(self, margin):
+        self.margin = margin
+        self.fetches = 0
+        self.coalesced = 0
+        self.flights = list()
+        self.lock = threading.Lock()
+
+    def fetch(self, layer, min_x, min_y, max_x, max_y, target, fetcher):
+        # fetcher(min_x, min_y, max_x, max_y, path) writes a GeoTIFF covering the bbox to path and returns True
+        bbox = (min_x, min_y, max_x, max_y)
+        with self.lock:
+            flight = next((f for f in self.flights if f.covers(layer, bbox)), None)
+            if flight is None:
+                flight = DemFlight(layer, (min_x - self.margin, min_y - self.margin, max_x + self.margin,
+                                           max_y + self.margin))
+                self.flights.append(flight)
+                self.fetches += 1
+                leader = True
+            else:
+                flight.users += 1
+                self.coalesced += 1
+                leader = False
+        metrics.increment('viewshed_dem_fetches_coalesced_total' if not leader else 'viewshed_dem_fetches_total')
+        try:
+            if leader:
+                try:
+                    flight.fetched = fetcher(*(flight.bbox + (flight.path,)))
+                    if flight.fetched:
+                        metrics.increment('viewshed_download_bytes_total', gdal.VSIStatL(flight.path).size)
+                finally:
+                    with self.lock:
+                        self.flights.remove(flight)
+                    flight.done.set()
+            else:
+                flight.done.wait()
+            if not flight.fetched:
+                return None
+            gdal.Translate(target, flight.path, format='GTiff', projWin=[min_x, max_y, max_x, min_y])
+            return target
+        finally:
+            with self.lock:
+                flight.users -= 1
+                if flight.users == 0:
+                    gdal.Unlink(flight.path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "fetches": self.fetches,
+                "coalesced": self.coalesced,
+                "in_flight": len(self.flights)
+            }
+
+
+class ResultCache(object):
+    """
+    Viewshed results keyed on normalized parameters, kept in memory and optionally on disk, least recently used first
+    evicted past the size limits. Results are held as their serialized JSON document, which is what the size limits
+    count and what responses and ETag hits send as is.
+    """
+
+    def __init__(self, size_limit, cache_dir, disk_limit, version):
+        self.size_limit = size_limit
+        self.cache_dir = cache_dir
+        self.disk_limit = disk_limit
+        self.version = version
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.size = 0
+        self.disk_size = 0
+        self.results = OrderedDict()
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+        if self.cache_dir is not None:
+            self.load()
+
+    def load(self):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        found = list()
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                path = os.path.join(self.cache_dir, name)
+                found.append((os.path.getmtime(path), name[:-5], os.path.getsize(path)))
+        for mtime, etag, size in sorted(found):
+            self.files[etag] = size
+            self.disk_size += size
+        self.evict()
+
+    def etag(self, key):
+        return hashlib.sha1(json.dumps([self.version, key], sort_keys=True)).hexdigest()
+
+    def get(self, etag):
+        with self.lock:
+            if etag in self.results:
+                self.hits += 1
+                data = self.results.pop(etag)
+                self.results[etag] = data
+                return data
+            if etag not in self.files:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.files[etag] = self.files.pop(etag)
+        path = os.path.join(self.cache_dir, etag + '.json')
+        try:
+            with open(path, 'r') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        self.remember(etag, data)
+        return data
+
+    def put(self, etag, result):
+        # Returns the JSON document of result as cached
+        data = json.dumps(result, separators=(',', ':'))
+        self.remember(etag, data)
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, etag + '.json')
+            part = path + '.' + str(uuid.uuid4())
+            with open(part, 'w') as f:
+                f.write(data)
+            os.rename(part, path)
+            with self.lock:
+                self.disk_size -= self.files.pop(etag, 0)
+                self.files[etag] = len(data)
+                self.disk_size += len(data)
+                self.evict()
+        return data
+
+    def remember(self, etag, data):
+        with self.lock:
+            if etag in self.results:
+                self.size -= len(self.results.pop(etag))
+            self.results[etag] = data
+            self.size += len(data)
+            self.evict()
+
+    def evict(self):
+        while self.size > self.size_limit and len(self.results) > 1:
+            etag, data = self.results.popitem(last=False)
+            self.size -= len(data)
+        while self.disk_size > self.disk_limit and len(self.files) > 1:
+            etag, size = self.files.popitem(last=False)
+            self.disk_size -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, etag + '.json'))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "results": len(self.results),
+                "size": self.size,
+                "size_limit": self.size_limit,
+                "disk_results": len(self.files),
+                "disk_size": self.disk_size,
+                "disk_limit": self.disk_limit
+            }
+
+
+dem_flights = DemFlights(DEM_FETCH_MARGIN)
+dem_cache = DemTileCache(wcs_client, DEM_CACHE_DIR, DEM_CACHE_SIZE_LIMIT, DEM_CACHE_TILE_SIZE)
+result_cache = ResultCache(RESULT_CACHE_SIZE_LIMIT, RESULT_CACHE_DIR, RESULT_CACHE_DISK_LIMIT, RESULT_CACHE_VERSION)
@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from Queue import Queue, Full
+from setting import JOB_WORKERS, JOB_QUEUE_DEPTH, JOB_TTL, JOB_DIR, JOB_PROGRESS_INTERVAL
+
+log = logging.getLogger(__name__)
+
+
+class Job(object):
+    def __init__(self, viewshed, store=None):
+        self.id = str(uuid.uuid4())
+        self.viewshed = viewshed
+        self.store = store
+        self.status = 'queued'
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.message = None
+        self.created = time.time()
+        self.finished = None
+        self.saved = 0.0
+
+    def progress(self, done, total):
+        self.done = done
+        self.total = total
+        # Other workers read progress from the store, it is written at most every JOB_PROGRESS_INTERVAL seconds
+        if self.store is not None and time.time() - self.saved > JOB_PROGRESS_INTERVAL:
+            self.save()
+
+    def run(self):
+        self.status = 'running'
+        self.save()
+        try:
+            self.result = self.viewshed.analysis(progress=self.progress)
+            self.status = 'finished' if self.result is not None else 'failed'
+            if self.result is None:
+                self.message = 'DEM could not be retrieved'
+        except Exception as e:
+            log.exception('Job %s failed' % self.id)
+            self.status = 'failed'
+            self.message = str(e)
+        finally:
+            # Whatever stopped the analysis, the job does not stay running
+            if self.status == 'running':
+                self.status = 'failed'
+                self.message = 'job interrupted'
+            self.viewshed = None
+            self.finished = time.time()
+            self.save()
+
+    def save(self):
+        if self.store is None:
+            return
+        self.saved = time.time()
+        try:
+            self.store.write(self)
+        except (IOError, OSError) as e:
+            log.info('Job %s could not be saved: %s' % (self.id, e))
+
+    def state(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "done": self.done,
+            "total": self.total,
+            "message": self.message
+        }
+
+
+class JobStore(object):
+    """
+    Job states and results as JSON files in a folder shared by every gunicorn worker, so that a job submitted to one
+    worker can be polled and fetched through any of them.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass
+
+    def get_path(self, job_id, kind):
+        return os.path.join(self.folder, '%s.%s.json' % (job_id, kind))
+
+    def write(self, job):
+        # The result goes first, a finished state is never visible before its result
+        if job.status == 'finished':
+            self.dump(self.get_path(job.id, 'result'), job.result)
+        self.dump(self.get_path(job.id, 'state'), dict(job.state(), created=job.created, finished=job.finished))
+
+    def dump(self, path, value):
+        part = path + '.' + str(uuid.uuid4())
+        with open(part, 'w') as f:
+            json.dump(value, f, separators=(',', ':'))
+        os.rename(part, path)
+
+    def read(self, job_id):
+        # Returns the job as last saved, without its result, or None
+        try:
+            with open(self.get_path(job_id, 'state'), 'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        job = Job(None, self)
+        job.id = state['id']
+        job.status = state['status']
+        job.done = state['done']
+        job.total = state['total']
+        job.message = state['message']
+        job.created = state['created']
+        job.finished = state['finished']
+        return job
+
+    def read_result(self, job_id):
+        try:
+            with open(self.get_path(job_id, 'result'), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def expire(self, ttl):
+        # Finished jobs of every worker older than ttl seconds, and what is left of jobs lost with their worker
+        now = time.time()
+        for name in os.listdir(self.folder):
+            if not name.endswith('.state.json'):
+                continue
+            job = self.read(name[:-len('.state.json')])
+            stale = job is not None and job.finished is None and now - job.created > 24 * ttl
+            if job is not None and (job.finished is not None and now - job.finished > ttl or stale):
+                self.remove(job.id)
+
+    def remove(self, job_id):
+        for kind in ('state', 'result'):
+            try:
+                os.remove(self.get_path(job_id, kind))
+            except OSError:
+                pass
+
+
+class JobQueue(object):
+    """
+    Bounded queue of viewshed jobs run by a fixed number of worker threads. The queue and its depth belong to one
+    process, job states and results go to a store shared by every worker. Finished jobs are only kept in the store,
+    where they expire ttl seconds after finishing, on lookup and on a timer.
+    """
+
+    def __init__(self, workers, depth, ttl, store):
+        self.workers = workers
+        self.ttl = ttl
+        self.store = store
+        self.queue = Queue(maxsize=depth)
+        self.jobs = dict()
+        self.lock = threading.Lock()
+        self.threads = list()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, name='viewshed-job-%s' % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            thread = threading.Thread(target=self.reap, name='viewshed-job-reaper')
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job.run()
+            except BaseException:
+                # A SystemExit raised by the analysis ends the job, not the thread and the queue capacity with it
+                log.exception('Job %s stopped' % job.id)
+            finally:
+                with self.lock:
+                    self.jobs.pop(job.id, None)
+                self.queue.task_done()
+
+    def reap(self):
+        while True:
+            time.sleep(min(self.ttl, 60))
+            try:
+                self.store.expire(self.ttl)
+            except OSError as e:
+                log.info('Job expiry failed: %s' % e)
+
+    def submit(self, viewshed):
+        self.start()
+        job = Job(viewshed, self.store)
+        job.save()
+        try:
+            self.queue.put_nowait(job)
+        except Full:
+            self.store.remove(job.id)
+            return None
+        with self.lock:
+            self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        # Jobs queued or running here are current, others come from the store with their result once finished
+        try:
+            uuid.UUID(job_id)
+        except ValueError:
+            return None
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+        job = self.store.read(job_id)
+        if job is None:
+            return None
+        if job.finished is not None and time.time() - job.finished > self.ttl:
+            self.store.remove(job_id)
+            return None
+        if job.status == 'finished':
+            job.result = self.store.read_result(job_id)
+            if job.result is None:
+                return None
+        return job
+
+
+job_queue = JobQueue(JOB_WORKERS, JOB_QUEUE_DEPTH, JOB_TTL, JobStore(JOB_DIR))
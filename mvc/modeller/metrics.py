@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from setting import METRICS_BUCKETS, METRICS_DIR, METRICS_FLUSH_INTERVAL
+
+METRICS_HELP = OrderedDict([
+    ('viewshed_request_seconds', ('histogram', 'Latency of requests to the gdal blueprint')),
+    ('viewshed_stage_seconds', ('histogram', 'Latency of viewshed pipeline stages')),
+    ('viewshed_download_bytes_total', ('counter', 'DEM bytes downloaded or assembled from cached tiles')),
+    ('viewshed_dem_fetches_total', ('counter', 'DEM fetches issued')),
+    ('viewshed_dem_fetches_coalesced_total', ('counter', 'DEM fetches saved by waiting on one in flight')),
+    ('viewshed_dem_pixels_total', ('counter', 'DEM pixels read')),
+    ('viewshed_rays_total', ('counter', 'Lines of sight cast')),
+    ('viewshed_visible_pixels_total', ('counter', 'Pixels found visible')),
+    ('viewshed_polygons_total', ('counter', 'Polygons produced by polygonize'))
+])
+
+
+class Metrics(object):
+    """
+    Process wide latency histograms and counters in the Prometheus text format. Stage timings are also collected per
+    request for the Server-Timing header, between begin_request and end_request on the same thread.
+
+    With a folder, every process writes a snapshot of its own metrics there, at most every interval seconds after a
+    request and before every exposition, and the exposition sums the snapshots of every process, so any gunicorn
+    worker answers for all of them. Snapshots of exited workers are kept so that counters never go down, the folder
+    is cleared when the server starts. Metrics counted by job threads show once their worker serves a request.
+    """
+
+    def __init__(self, buckets, folder=None, interval=1.0):
+        self.buckets = tuple(buckets)
+        self.folder = folder
+        self.interval = interval
+        self.histograms = OrderedDict()
+        self.counters = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.path = None
+        self.flushed = 0.0
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            histogram = self.histograms[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.observe('viewshed_stage_seconds', elapsed, stage=stage)
+            timings = getattr(self.local, 'timings', None)
+            if timings is not None:
+                timings[stage] = timings.get(stage, 0.0) + elapsed
+
+    def begin_request(self):
+        self.local.timings = OrderedDict()
+        self.local.start = time.time()
+
+    def end_request(self, endpoint):
+        # Returns the stage timings of the request followed by its total, in seconds
+        timings = getattr(self.local, 'timings', None)
+        if timings is None:
+            return OrderedDict()
+        timings['total'] = time.time() - self.local.start
+        self.observe('viewshed_request_seconds', timings['total'], endpoint=endpoint or 'unknown')
+        self.local.timings = None
+        if self.folder is not None and time.time() - self.flushed > self.interval:
+            self.flush()
+        return timings
+
+    def snapshot(self):
+        with self.lock:
+            histograms = [(key, (list(value[0]), value[1], value[2])) for key, value in self.histograms.items()]
+            counters = list(self.counters.items())
+        return histograms, counters
+
+    def reset(self):
+        # Called in every forked worker, metrics of the parent are in its own snapshot
+        with self.lock:
+            self.histograms = OrderedDict()
+            self.counters = OrderedDict()
+            self.path = None
+            self.flushed = 0.0
+
+    def clear(self):
+        # Drops the snapshots of every process, when the server starts
+        if self.folder is None or not os.path.isdir(self.folder):
+            return
+        for name in os.listdir(self.folder):
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+
+    def flush(self):
+        if self.folder is None:
+            return
+        histograms, counters = self.snapshot()
+        self.flushed = time.time()
+        if self.path is None:
+            if not os.path.isdir(self.folder):
+                try:
+                    os.makedirs(self.folder)
+                except OSError:
+                    pass
+            # The pid alone could be reused by a later worker and overwrite the counters of an exited one
+            self.path = os.path.join(self.folder, '%s-%s.json' % (os.getpid(), uuid.uuid4().hex))
+        part = '%s.%s.part' % (self.path, uuid.uuid4().hex)
+        try:
+            with open(part, 'w') as f:
+                json.dump({"histograms": [[name, labels, value] for (name, labels), value in histograms],
+                           "counters": [[name, labels, value] for (name, labels), value in counters]}, f)
+            os.rename(part, self.path)
+        except (IOError, OSError):
+            pass
+
+    def collect(self):
+        # Metrics of every process summed, read from their snapshots
+        self.flush()
+        histograms = OrderedDict()
+        counters = OrderedDict()
+        for name in sorted(os.listdir(self.folder)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.folder, name), 'r') as f:
+                    snapshot = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            for metric, labels, (buckets, total, count) in snapshot['histograms']:
+                key = (metric, tuple(tuple(label) for label in labels))
+                merged = histograms.setdefault(key, ([0] * len(self.buckets), [0.0], [0]))
+                for i, observed in enumerate(buckets):
+                    merged[0][i] += observed
+                merged[1][0] += total
+                merged[2][0] += count
+            for metric, labels, value in snapshot['counters']:
+                key = (metric, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+        return [(key, (value[0], value[1][0], value[2][0])) for key, value in histograms.items()], \
+            list(counters.items())
+
+    def exposition(self):
+        histograms, counters = self.collect() if self.folder is not None else self.snapshot()
+        lines = list()
+        for name, (kind, description) in METRICS_HELP.items():
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (metric, labels), (buckets, total, count) in histograms:
+                if metric != name:
+                    continue
+                for bound, observed in zip(self.buckets, buckets):
+                    lines.append('%s_bucket%s %s' % (name, get_labels(labels + (('le', repr(bound)),)), observed))
+                lines.append('%s_bucket%s %s' % (name, get_labels(labels + (('le', '+Inf'),)), count))
+                lines.append('%s_sum%s %s' % (name, get_labels(labels), repr(total)))
+                lines.append('%s_count%s %s' % (name, get_labels(labels), count))
+            for (metric, labels), value in counters:
+                if metric == name:
+                    lines.append('%s%s %s' % (name, get_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+def get_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def server_timing(timings):
+    return ', '.join('%s;dur=%.1f' % (stage, seconds * 1000.0) for stage, seconds in timings.items())
+
+
+metrics = Metrics(METRICS_BUCKETS, METRICS_DIR, METRICS_FLUSH_INTERVAL)
@@ -9,5 +9,14 @@ PROP_DEFAULT = {
     "use_swath": True,
     "earth_radius": 6371000.0,
     "resolution": 30,
-    "esri": False
+    "esri": False,
+    "engine": "numpy",
+    "algorithm": "ray",
+    "workers": 1,
+    "simplify": 0.0,
+    "min_area": 0.0,
+    "precision": None,
+    "pyramid": False
 }
+
+SWATH_MODES = ('auto', 'split')  # swath values chosen from the view distance and the DEM resolution
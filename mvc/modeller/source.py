@@ -0,0 +1,171 @@
+import uuid
+import logging
+import threading
+from osgeo import gdal, gdal_array
+from mvc.modeller.wcs import wcs_client
+from mvc.modeller.cache import dem_cache, dem_flights
+from mvc.modeller.algorithm import coverage_payload, read_image, get_srs
+from setting import DEM_SOURCE, DEM_LOCAL_PATHS, DEM_CACHE_ENABLED, DEM_PRELOAD
+
+log = logging.getLogger(__name__)
+
+
+class DemSource(object):
+    """
+    Where elevation comes from. open returns the DEM covering a bbox of a layer as read_image accepts it, a path or an
+    open dataset, or None when it is not available. Every DEM opened is handed back to release once read. is_local
+    tells whether a bbox is read on this host rather than downloaded.
+    """
+
+    def open(self, layer, min_x, min_y, max_x, max_y):
+        raise NotImplementedError
+
+    def is_local(self, layer, min_x, min_y, max_x, max_y):
+        return False
+
+    def release(self, dem):
+        pass
+
+    def reset(self):
+        # Called in every forked worker, drops what must not be shared with the parent process
+        pass
+
+
+class WcsDemSource(DemSource):
+    """
+    GeoServer coverages written to /vsimem/, through the DEM tile cache when given. Concurrent fetches are coalesced
+    when flights is given.
+    """
+
+    def __init__(self, client, cache=None, flights=None):
+        self.client = client
+        self.cache = cache
+        self.flights = flights
+
+    def open(self, layer, min_x, min_y, max_x, max_y):
+        target = '/vsimem/' + str(uuid.uuid4()) + '.tif'
+        if self.flights is not None:
+            return self.flights.fetch(layer, min_x, min_y, max_x, max_y, target,
+                                      lambda *bbox: self.request(layer, *bbox))
+        return self.request(layer, min_x, min_y, max_x, max_y, target)
+
+    def request(self, layer, min_x, min_y, max_x, max_y, target):
+        if self.cache is not None:
+            return self.cache.fetch(layer, min_x, min_y, max_x, max_y, target)
+        return self.client.download(coverage_payload(layer, min_x, min_y, max_x, max_y), target)
+
+    def release(self, dem):
+        gdal.Unlink(dem)
+
+    def reset(self):
+        self.client.reset()
+
+
+class LocalDemSource(DemSource):
+    """
+    Local GeoTIFF or VRT mosaics, one per layer. Datasets stay open between requests, a dataset is used by one
+    request at a time, so there are as many open copies of a mosaic as concurrent requests reading it. read_image
+    only reads the window of the bbox.
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.idle = dict((layer, list()) for layer in paths)
+        self.busy = dict()
+        self.lock = threading.Lock()
+
+    def open(self, layer, min_x, min_y, max_x, max_y):
+        if layer not in self.paths:
+            log.info('No local DEM for %s' % layer)
+            return None
+        with self.lock:
+            dataset = self.idle[layer].pop() if self.idle[layer] else None
+        if dataset is None:
+            dataset = gdal.Open(self.paths[layer])
+            if dataset is None:
+                log.info('Unable to open %s' % self.paths[layer])
+                return None
+        with self.lock:
+            self.busy[id(dataset)] = layer
+        return dataset
+
+    def is_local(self, layer, min_x, min_y, max_x, max_y):
+        return layer in self.paths
+
+    def release(self, dem):
+        with self.lock:
+            self.idle[self.busy.pop(id(dem))].append(dem)
+
+    def reset(self):
+        # Open datasets share file offsets with the parent process
+        with self.lock:
+            self.idle = dict((layer, list()) for layer in self.paths)
+            self.busy = dict()
+
+
+class PreloadedDemSource(DemSource):
+    """
+    Regions of a layer read into memory once, before gunicorn forks its workers so that they share the pages copy on
+    write. A bbox inside a region gets an in-memory dataset over the shared array, anything else goes to source.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.regions = list()
+        self.handed = set()
+        self.lock = threading.Lock()
+
+    def preload(self, layer, min_x, min_y, max_x, max_y):
+        dem = self.source.open(layer, min_x, min_y, max_x, max_y)
+        if dem is None:
+            log.info('Unable to preload %s' % layer)
+            return False
+        try:
+            image = read_image(dem, (min_x, min_y, max_x, max_y))
+        finally:
+            self.source.release(dem)
+        if image is None:
+            return False
+        geotransform, matrix = image
+        self.regions.append((layer, (min_x, min_y, max_x, max_y), geotransform, matrix))
+        log.info('Preloaded %s bytes of %s' % (matrix.nbytes, layer))
+        return True
+
+    def open(self, layer, min_x, min_y, max_x, max_y):
+        for name, bbox, geotransform, matrix in self.regions:
+            if self.covers(name, bbox, layer, min_x, min_y, max_x, max_y):
+                dataset = gdal_array.OpenArray(matrix)
+                dataset.SetGeoTransform(geotransform)
+                dataset.SetProjection(get_srs().ExportToWkt())
+                with self.lock:
+                    self.handed.add(id(dataset))
+                return dataset
+        return self.source.open(layer, min_x, min_y, max_x, max_y)
+
+    def covers(self, name, bbox, layer, min_x, min_y, max_x, max_y):
+        return name == layer and bbox[0] <= min_x and bbox[1] <= min_y and max_x <= bbox[2] and max_y <= bbox[3]
+
+    def is_local(self, layer, min_x, min_y, max_x, max_y):
+        return any(self.covers(name, bbox, layer, min_x, min_y, max_x, max_y) for name, bbox, _, _ in self.regions) \
+            or self.source.is_local(layer, min_x, min_y, max_x, max_y)
+
+    def release(self, dem):
+        with self.lock:
+            if id(dem) in self.handed:
+                self.handed.remove(id(dem))
+                return
+        self.source.release(dem)
+
+    def reset(self):
+        self.source.reset()
+
+
+def get_dem_source(name, preload):
+    if name == 'local':
+        source = LocalDemSource(DEM_LOCAL_PATHS)
+    else:
+        source = WcsDemSource(wcs_client, dem_cache if DEM_CACHE_ENABLED else None, dem_flights)
+    return PreloadedDemSource(source) if preload else source
+
+
+dem_source = get_dem_source(DEM_SOURCE, DEM_PRELOAD)
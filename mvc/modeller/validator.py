@@ -1,4 +1,5 @@
 import logging
+from mvc.modeller.properties import SWATH_MODES
 
 log = logging.getLogger(__name__)
 
@@ -11,3 +12,9 @@ def validate_coords(coordinates):
     except Exception as e:
         log.info(e)
         return False
+
+
+def validate_swath(swath):
+    if swath in SWATH_MODES:
+        return True
+    return isinstance(swath, (int, long, float)) and not isinstance(swath, bool) and swath > 0.0
@@ -0,0 +1,32 @@
+import time
+import logging
+from mvc.modeller.source import dem_source
+from mvc.modeller.metrics import metrics
+from mvc.modeller.algorithm import get_srs, get_driver, get_wgs84
+from setting import DEM_PRELOAD, WARM_DRIVERS
+
+log = logging.getLogger(__name__)
+
+
+def warm_up():
+    # Builds the state every request reuses: the spatial reference, the drivers, the WGS84 projection and the
+    # preloaded DEM regions. Run once per process, in the gunicorn master when the app is preloaded.
+    start = time.time()
+    metrics.clear()
+    get_srs().ExportToWkt()
+    for name in WARM_DRIVERS:
+        get_driver(name)
+    get_wgs84()
+    for layer, bbox in DEM_PRELOAD:
+        dem_source.preload(layer, *bbox)
+    metrics.flush()
+    elapsed = time.time() - start
+    log.info('Warmed up in %.3fs' % elapsed)
+    return elapsed
+
+
+def after_fork():
+    # Datasets and connections opened in the master are reopened by every worker, metrics of the master stay in its
+    # own snapshot
+    dem_source.reset()
+    metrics.reset()
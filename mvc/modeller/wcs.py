@@ -0,0 +1,53 @@
+import logging
+import requests
+from osgeo import gdal
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from setting import GEOSERVER_URL, WCS_POOL_SIZE, WCS_TIMEOUT, WCS_RETRIES, WCS_BACKOFF
+
+log = logging.getLogger(__name__)
+
+
+class WcsClient(object):
+    """
+    One pooled HTTP session to GeoServer shared by every request, connections are kept alive between coverages and
+    failed requests are retried with exponential backoff.
+    """
+
+    def __init__(self, url, pool_size, timeout, retries, backoff):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(500, 502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_coverage(self, querystring):
+        # Returns the coverage bytes, gzip or deflate encoded responses are decoded by requests
+        try:
+            response = self.session.get(url=self.url, params=querystring, timeout=self.timeout)
+        except requests.RequestException as e:
+            log.info('WCS request failed: %s' % e)
+            return None
+        if response.status_code != 200:
+            log.info('WCS request failed: %s' % response.status_code)
+            return None
+        return response.content
+
+    def download(self, querystring, target):
+        # Writes the coverage to target, usually a /vsimem/ path so that it never touches the disk
+        content = self.get_coverage(querystring)
+        if content is None:
+            return None
+        gdal.FileFromMemBuffer(target, content)
+        return target
+
+    def reset(self):
+        # Connections opened before a fork would be shared with the parent, the pool reconnects on the next request
+        self.session.close()
+
+
+wcs_client = WcsClient(GEOSERVER_URL, WCS_POOL_SIZE, WCS_TIMEOUT, WCS_RETRIES, WCS_BACKOFF)
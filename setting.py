@@ -1,4 +1,6 @@
 import os
+import multiprocessing
+import tempfile
 
 # GeoServer settings
 DEM_30METERS = 'demo:srtm1v3elevation'
@@ -11,6 +13,91 @@ if os.uname()[0] == 'Darwin':
 if os.uname()[0] == 'Linux':
     GEOSERVER_HOST = 'docker.for.mac.localhost'
     GEOSERVER_URL = 'http://' + GEOSERVER_HOST + '/geoserver/wcs'
+GEOSERVER_URL = os.environ.get('GEOSERVER_URL', GEOSERVER_URL)
+
+# GeoServer client settings
+WCS_POOL_SIZE = 16  # keep-alive connections kept to GeoServer
+WCS_TIMEOUT = (3.05, 60)  # seconds to connect and to wait between bytes of a coverage
+WCS_RETRIES = 3  # retries of failed connections and 5xx responses
+WCS_BACKOFF = 0.5  # seconds, doubled after every retry
+
+# DEM source settings, wcs reads coverages from GeoServer, local reads GeoTIFF or VRT mosaics on this host
+DEM_SOURCE = os.environ.get('DEM_SOURCE', 'wcs')
+DEM_LOCAL_PATHS = {
+    DEM_30METERS: os.environ.get('DEM_30METERS_PATH', '/data/dem/srtm1v3.vrt'),
+    DEM_10METERS: os.environ.get('DEM_10METERS_PATH', '/data/dem/ned13.vrt')
+}
+
+# Warm worker settings, DEM regions read into memory before gunicorn forks its workers, shared copy on write
+# DEM_PRELOAD_BBOX is min_x,min_y,max_x,max_y in degrees, of the DEM_PRELOAD_LAYER layer
+DEM_PRELOAD = [(os.environ.get('DEM_PRELOAD_LAYER', DEM_30METERS),
+                tuple(float(value) for value in os.environ['DEM_PRELOAD_BBOX'].split(',')))] \
+    if os.environ.get('DEM_PRELOAD_BBOX') else []
+WARM_DRIVERS = ('MEM', 'GTiff', 'PNG', 'Memory')  # created once at startup, Memory is the OGR driver
+
+# DEM tile cache settings
+DEM_CACHE_ENABLED = True
+DEM_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'viewshed-dem-cache')
+DEM_CACHE_SIZE_LIMIT = 1024 * 1024 * 1024  # bytes on disk, least recently used tiles are evicted first
+DEM_CACHE_TILE_SIZE = {
+    DEM_30METERS: 0.1,  # degrees, 360 x 360 pixels
+    DEM_10METERS: 0.05  # degrees, 540 x 540 pixels
+}
+
+# Concurrent DEM fetches are coalesced when one bbox lies inside another one in flight. Fetches are padded by this
+# margin (degrees) so that observers clicking close to each other share a fetch.
+DEM_FETCH_MARGIN = 0.0025
+
+# DEM pixel size (degrees), used to snap observers to pixel centers
+DEM_PIXEL_SIZE = {
+    DEM_30METERS: 1.0 / 3600,  # 1 arc-second
+    DEM_10METERS: 1.0 / 10800  # 1/3 arc-second
+}
+
+# Viewshed result cache settings
+RESULT_CACHE_ENABLED = True
+RESULT_CACHE_SIZE_LIMIT = 256 * 1024 * 1024  # bytes of serialized results kept in memory
+RESULT_CACHE_DIR = None  # disk tier directory shared by every worker, None to keep results in worker memory only
+RESULT_CACHE_DISK_LIMIT = 1024 * 1024 * 1024  # bytes on disk
+RESULT_CACHE_VERSION = 1  # bump to invalidate cached results and ETags, e.g. after a DEM update
+
+# Raster output settings
+RASTER_BLOCK_SIZE = 256  # pixels per side of GeoTIFF tiles, overviews are built until one block holds the raster
+TILE_SIZE = 256  # pixels per side of XYZ tiles
+TILE_COLOR = (255, 140, 0, 160)  # RGBA of visible cells, other cells are transparent
+
+# Batch and cumulative viewshed settings
+BATCH_MAX_OBSERVERS = 64
+BATCH_MAX_PIXELS = 25 * 1000 * 1000  # DEM pixels of the bbox holding every observer, read at once as float32
+BATCH_WORKERS = 2  # worker processes of the pool every batch and cumulative viewshed of a gunicorn worker shares
+BATCH_SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()  # DEMs mapped by the pool
+
+# Single viewshed settings
+SECTOR_MAX_WORKERS = multiprocessing.cpu_count()  # upper bound of the workers argument
+
+# View distance settings (meter), distances past VIEWSHED_MAX_DISTANCE require the pyramid mode
+VIEWSHED_MIN_DISTANCE = float(os.environ.get('VIEWSHED_MIN_DISTANCE', 500.0))
+VIEWSHED_MAX_DISTANCE = float(os.environ.get('VIEWSHED_MAX_DISTANCE', 5000.0))
+
+# Pyramid viewshed settings, the DEM is used at full resolution up to PYRAMID_BASE_DISTANCE and every further level
+# doubles both the cell size and the distance it reaches. Levels are read from the full resolution DEM, so distances
+# past PYRAMID_BASE_DISTANCE need the local DEM source or a preloaded region, they are refused through WCS.
+PYRAMID_MAX_DISTANCE = float(os.environ.get('PYRAMID_MAX_DISTANCE', 50000.0))
+PYRAMID_BASE_DISTANCE = 5000.0
+
+# Viewshed job settings, every gunicorn worker runs its own queue, states and results are read through JOB_DIR by
+# any worker. JOB_DIR has to be on a shared filesystem when workers run on several hosts.
+JOB_WORKERS = 2  # worker threads running queued jobs
+JOB_QUEUE_DEPTH = 16  # jobs waiting to run, further submissions are rejected with 429
+JOB_TTL = 3600  # seconds a finished job and its result are kept
+JOB_DIR = os.path.join(tempfile.gettempdir(), 'viewshed-jobs')  # job states and results, shared by every worker
+JOB_PROGRESS_INTERVAL = 1.0  # seconds between progress writes of a running job to JOB_DIR
+
+# Metrics settings
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # seconds
+SERVER_TIMING_ENABLED = True  # per-request stage timings in a Server-Timing response header
+METRICS_DIR = os.path.join(tempfile.gettempdir(), 'viewshed-metrics')  # snapshots of every worker, None for one worker
+METRICS_FLUSH_INTERVAL = 1.0  # seconds between snapshots of a worker
 
 # Flask settings
 FLASK_DEBUG = False  # Do not use debug mode in production
@@ -0,0 +1,169 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import numpy as np
+from osgeo import gdal
+from benchmark.sources import CENTER, LAYER, CoverageHandler, write_dem
+from mvc.modeller.wcs import WcsClient
+from mvc.modeller.cache import DemTileCache, DemFlights
+from mvc.modeller.algorithm import read_image
+
+TILE_SIZE = {LAYER: 0.05}  # degrees, 180 x 180 pixels of the 1 arc-second synthetic DEM
+BBOX = (CENTER[0] - 0.06, CENTER[1] - 0.06, CENTER[0] + 0.06, CENTER[1] + 0.06)
+INNER = (CENTER[0] - 0.02, CENTER[1] - 0.02, CENTER[0] + 0.02, CENTER[1] + 0.02)
+
+
+def read_target(target, bbox):
+    try:
+        return read_image(target, bbox)[1]
+    finally:
+        gdal.Unlink(target)
+
+
+class DemTileCacheTest(unittest.TestCase):
+    """
+    The DEM tile cache against a local stub WCS server, which cuts coverages out of a synthetic DEM on disk.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp(prefix='viewshed-cache-')
+        cls.path = os.path.join(cls.folder, 'dem.tif')
+        write_dem(cls.path, 720, 1.0 / 3600)
+        CoverageHandler.dem = gdal.Open(cls.path)
+        cls.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), CoverageHandler)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.client = WcsClient('http://127.0.0.1:%s/geoserver/wcs' % cls.server.server_port, 4, (3.05, 60), 0, 0)
+        cls.expected = read_image(cls.path, BBOX)[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        CoverageHandler.dem = None
+        shutil.rmtree(cls.folder, ignore_errors=True)
+
+    def setUp(self):
+        self.tiles = tempfile.mkdtemp(prefix='tiles-', dir=self.folder)
+        self.cache = DemTileCache(self.client, self.tiles, 1024 * 1024 * 1024, TILE_SIZE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tiles, ignore_errors=True)
+
+    def read_cached(self, cache):
+        target = '/vsimem/cache-test.tif'
+        self.assertEqual(cache.fetch(LAYER, BBOX[0], BBOX[1], BBOX[2], BBOX[3], target), target)
+        return read_target(target, BBOX)
+
+    def test_cached_bbox_matches_dem(self):
+        cached = self.read_cached(self.cache)
+        self.assertEqual(cached.shape, self.expected.shape)
+        self.assertTrue(np.allclose(cached, self.expected))
+        self.assertEqual(self.cache.hits, 0)
+        self.assertEqual(self.cache.misses, len(list(self.cache.get_tile_range(LAYER, *BBOX))))
+
+    def test_second_read_served_from_tiles(self):
+        self.read_cached(self.cache)
+        misses = self.cache.misses
+        self.assertTrue(np.allclose(self.read_cached(self.cache), self.expected))
+        self.assertEqual(self.cache.misses, misses)
+        self.assertEqual(self.cache.hits, misses)
+
+    def test_deleted_tile_fetched_again(self):
+        # As another worker evicting it would
+        self.read_cached(self.cache)
+        misses = self.cache.misses
+        os.remove(self.cache.get_tile_path(LAYER, *next(self.cache.get_tile_range(LAYER, *BBOX))))
+        self.assertTrue(np.allclose(self.read_cached(self.cache), self.expected))
+        self.assertEqual(self.cache.misses, misses + 1)
+
+    def test_size_limit_shared_by_workers(self):
+        # A second worker on the same folder, limited to half of what is on disk
+        self.read_cached(self.cache)
+        limit = self.cache.stats()['size'] // 2
+        worker = DemTileCache(self.client, self.tiles, limit, TILE_SIZE)
+        self.assertLessEqual(worker.stats()['size'], limit)
+        self.assertLessEqual(self.cache.stats()['size'], limit)
+        self.assertGreater(worker.evictions, 0)
+        self.assertTrue(np.allclose(self.read_cached(self.cache), self.expected))
+
+
+class DemFlightsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp(prefix='viewshed-flights-')
+        cls.path = os.path.join(cls.folder, 'dem.tif')
+        write_dem(cls.path, 720, 1.0 / 3600)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder, ignore_errors=True)
+
+    def setUp(self):
+        self.flights = DemFlights(0.01)
+        self.calls = list()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def fetcher(self, min_x, min_y, max_x, max_y, path):
+        # Held until released, so that other fetches find it in flight
+        self.calls.append((min_x, min_y, max_x, max_y))
+        self.started.set()
+        self.release.wait(30)
+        gdal.Translate(path, self.path, format='GTiff', projWin=[min_x, max_y, max_x, min_y])
+        return True
+
+    def failing_fetcher(self, min_x, min_y, max_x, max_y, path):
+        self.calls.append((min_x, min_y, max_x, max_y))
+        self.started.set()
+        self.release.wait(30)
+        return False
+
+    def fetch(self, bbox, results, name, fetcher):
+        target = '/vsimem/flight-test-%s.tif' % name
+        if self.flights.fetch(LAYER, bbox[0], bbox[1], bbox[2], bbox[3], target, fetcher) is None:
+            results[name] = None
+        else:
+            results[name] = read_target(target, bbox)
+
+    def fetch_together(self, first, second, fetcher, coalesced):
+        # Starts the second fetch once the first one is in flight, and releases both once the second one either
+        # joined the flight or started its own fetch
+        results = dict()
+        leader = threading.Thread(target=self.fetch, args=(first, results, 'first', fetcher))
+        leader.start()
+        self.assertTrue(self.started.wait(30))
+        other = threading.Thread(target=self.fetch, args=(second, results, 'second', fetcher))
+        other.start()
+        while other.is_alive() and (self.flights.stats()['coalesced'] == 0 if coalesced else len(self.calls) < 2):
+            other.join(0.01)
+        self.release.set()
+        leader.join(30)
+        other.join(30)
+        return results
+
+    def test_inner_fetch_coalesced(self):
+        results = self.fetch_together(BBOX, INNER, self.fetcher, True)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.flights.stats(), {"fetches": 1, "coalesced": 1, "in_flight": 0})
+        self.assertTrue(np.allclose(results['first'], read_image(self.path, BBOX)[1]))
+        self.assertTrue(np.allclose(results['second'], read_image(self.path, INNER)[1]))
+
+    def test_outer_fetch_not_coalesced(self):
+        results = self.fetch_together(INNER, BBOX, self.fetcher, False)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.flights.stats(), {"fetches": 2, "coalesced": 0, "in_flight": 0})
+        self.assertTrue(np.allclose(results['second'], read_image(self.path, BBOX)[1]))
+
+    def test_failed_fetch_fails_coalesced(self):
+        results = self.fetch_together(BBOX, INNER, self.failing_fetcher, True)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, {"first": None, "second": None})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+import numpy as np
+from benchmark.synthetic import DEMS, EARTH_RADIUS, get_geotransform, get_shape
+from mvc.modeller.algorithm import calculate_visibility, RayTemplate
+
+OBSERVER = (-105.0, 40.0)
+PIXEL_SIZE = 1.0 / 3600
+RADIUS = 1000.0
+
+
+def get_visibility(dem, engine, curvature, swath):
+    shape = get_shape(OBSERVER, RADIUS, PIXEL_SIZE)
+    geotransform = get_geotransform(OBSERVER, shape, PIXEL_SIZE)
+    return calculate_visibility(OBSERVER, 1.7, 0.0, RADIUS, swath, curvature, curvature, 0.13, True, EARTH_RADIUS,
+                                False, engine, 'ray', 1, geotransform, DEMS[dem](shape))
+
+
+class EngineTest(unittest.TestCase):
+    def test_numpy_matches_loop(self):
+        # The loop engine computes every slope on its own, any difference points at the shared slope window
+        for dem in sorted(DEMS):
+            for curvature in (False, True):
+                for swath in (1.0, 'auto'):
+                    numpy = get_visibility(dem, 'numpy', curvature, swath)
+                    loop = get_visibility(dem, 'loop', curvature, swath)
+                    self.assertTrue(np.count_nonzero(loop) > 1)
+                    self.assertTrue(np.array_equal(numpy, loop), '%s, curvature %s, swath %s: %s cells differ' % (
+                        dem, curvature, swath, np.count_nonzero(numpy != loop)))
+
+
+
+class RayTemplateTest(unittest.TestCase):
+    def test_offsets_past_int16(self):
+        sectors = [[(i, -i // 2) for i in range(1, 40000, 7)], [(-1, 0), (-2, 0)]]
+        template = RayTemplate(sectors)
+        self.assertEqual(template.dx.dtype, np.int32)
+        xs, ys, valid = template.translate((10, 20), 0, 2)
+        self.assertEqual(xs[0, template.lengths[0] - 1], 10 + sectors[0][-1][0])
+        self.assertEqual(ys[0, template.lengths[0] - 1], 20 + sectors[0][-1][1])
+
+    def test_offsets_within_int16(self):
+        template = RayTemplate([[(1, 1), (2, 2)], [(-1, 0)]])
+        self.assertEqual(template.dx.dtype, np.int16)
+
+
+if __name__ == '__main__':
+    unittest.main()
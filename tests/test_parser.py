@@ -0,0 +1,35 @@
+import unittest
+from flask import Flask
+from mvc.controller.parser import viewshed_arguments
+from mvc.controller.namespace.wps import parse_viewshed
+from setting import VIEWSHED_MIN_DISTANCE, VIEWSHED_MAX_DISTANCE
+
+app = Flask(__name__)
+
+
+def parse(querystring):
+    with app.test_request_context('/gdal/wps/viewshed?' + querystring):
+        return viewshed_arguments.parse_args()
+
+
+class PyramidArgumentTest(unittest.TestCase):
+    def test_false_is_false(self):
+        for value in ('false', 'False', '0'):
+            self.assertFalse(parse('coordinates=-105.0,40.0&pyramid=' + value)['pyramid'])
+        self.assertTrue(parse('coordinates=-105.0,40.0&pyramid=true')['pyramid'])
+        self.assertFalse(parse('coordinates=-105.0,40.0')['pyramid'])
+
+    def test_stream_false_is_false(self):
+        self.assertFalse(parse('coordinates=-105.0,40.0&stream=false')['stream'])
+        self.assertTrue(parse('coordinates=-105.0,40.0&stream=true')['stream'])
+
+    def test_false_keeps_max_distance(self):
+        args = parse('coordinates=-105.0,40.0&distance=%s&pyramid=false' % (VIEWSHED_MAX_DISTANCE * 2))
+        viewshed, message = parse_viewshed(args)
+        self.assertIsNone(viewshed)
+        self.assertEqual(message, {"message": "view distance must be between %s and %s" % (VIEWSHED_MIN_DISTANCE,
+                                                                                           VIEWSHED_MAX_DISTANCE)})
+
+
+if __name__ == '__main__':
+    unittest.main()
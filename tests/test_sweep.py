@@ -0,0 +1,18 @@
+import unittest
+from benchmark.synthetic import DEMS
+from benchmark.sweep import THRESHOLD, run_case
+
+
+class SweepTest(unittest.TestCase):
+    def test_sweep_agrees_with_rays(self):
+        # The ring sweep interpolates horizons, it may only differ from the Bresenham rays on a few cells
+        for dem in sorted(DEMS):
+            for radius in (1000.0, 5000.0):
+                for curvature in (False, True):
+                    result = run_case(dem, radius, curvature, 1.7)
+                    self.assertGreaterEqual(result['agreement'], THRESHOLD, '%s, %s m, curvature %s: %.4f' % (
+                        dem, radius, curvature, result['agreement']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,12 @@
 import os
 import logging.config
 from mvc.controller.flaskapi import api
-from flask import Flask, Blueprint, send_from_directory
+from flask import Flask, Blueprint, Response, request, send_from_directory
+from mvc.modeller.warm import warm_up
+from mvc.modeller.metrics import metrics, server_timing
 from mvc.controller.namespace.wps import ns as viewshed_namespace
 from setting import RESTPLUS_SWAGGER_UI_DOC_EXPANSION, RESTPLUS_VALIDATE, RESTPLUS_MASK_SWAGGER, \
-    RESTPLUS_ERROR_404_HELP, FLASK_DEBUG
+    RESTPLUS_ERROR_404_HELP, FLASK_DEBUG, SERVER_TIMING_ENABLED
 
 uri = 'gdal'
 logging.config.fileConfig('logging.conf')
@@ -18,6 +20,26 @@ app.config['ERROR_404_HELP'] = RESTPLUS_ERROR_404_HELP
 control = Blueprint(uri, __name__, url_prefix='/' + uri)
 api.init_app(control)
 api.add_namespace(viewshed_namespace)
+
+
+@control.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
+
+
+@control.before_request
+def begin_timing():
+    metrics.begin_request()
+
+
+@control.after_request
+def end_timing(response):
+    timings = metrics.end_request(request.endpoint)
+    if SERVER_TIMING_ENABLED:
+        response.headers['Server-Timing'] = server_timing(timings)
+    return response
+
+
 app.register_blueprint(control)
 
 
@@ -27,4 +49,5 @@ def favicon():
 
 
 if __name__ == '__main__':
+    warm_up()
     app.run(host='0.0.0.0', debug=FLASK_DEBUG)